@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+'''
+Synthetic load benchmark for pyBLM's decode and encode paths - no hardware needed.
+
+Builds a BLM for the 1, 2 and 4 pad layouts on counting null ports, drives Seq.callback and Pad.press with
+generated traffic, and reports messages per second, per message latency percentiles, and for each port the
+messages and bytes sent and the messages its writer dropped.
+
+Captures recorded with pyBLM.py --capture can be replayed the same way, at recorded speed or as fast as possible.
+
+    ./bench.py
+    ./bench.py --layouts 4 --scenarios rows cols --frames 500
+    ./bench.py --replay session.cap --fast
+'''
+
+import argparse, random, sys, threading, time
+import mido
+from pyBLM import pyBLM, Capture, Pad, Seq, drivers, read_capture
+
+
+class CountingPort:
+    '''null output port - counts messages and bytes.  Has an rtmidi style send_message, so RawOutput sends raw bytes to it'''
+
+    def __init__(self, name):
+        self.name = name
+        self.messages = 0
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def send_message(self, data):
+        with self.lock:
+            self.messages += 1
+            self.bytes += len(data)
+
+    def send(self, msg):
+        self.send_message(msg.bytes())
+
+    def reset(self):
+        with self.lock:
+            self.messages = 0
+            self.bytes = 0
+
+    def close(self):
+        pass
+
+
+class NullInput:
+    '''null input port - pyBLM installs its callbacks here, the benchmark calls the handlers directly'''
+
+    def __init__(self, name):
+        self.name = name
+        self.callback = None
+
+    def close(self):
+        pass
+
+
+def build_blm(numpads, max_flush_rate=100, driver=None, **kwargs):
+    '''
+    Builds a pyBLM for numpads Launchpads on null ports, the same way connect/grid_config would.
+    driver is the pads' driver class - the classic Launchpad if None.
+    Returns the BLM, with the flush scheduler and port writers running.
+    '''
+    blm = pyBLM(max_flush_rate, run=False, layout_cache=None, **kwargs)
+    for padnum in range(numpads):
+        name = "bench pad %i" % padnum
+        blm.pad.append( Pad(blm, name, padnum, outport=CountingPort(name), inport=NullInput(name), driver=driver) )
+
+    blm.seq_BLM_portnum = 1
+    blm.seq = Seq("bench seq", 1, blm, outport=CountingPort("bench seq"), inport=NullInput("bench seq"))
+    blm.grid_config()
+    blm.scheduler.start()
+
+    drain(blm)
+    for port in ports(blm):
+        port.reset()
+    return blm
+
+
+def ports(blm):
+    return [ pad.outport for pad in blm.pad ] + [ blm.seq.outport ]
+
+
+def writers(blm):
+    '''the port writers, in the same order as ports'''
+    return [ pad.rawport for pad in blm.pad ] + [ blm.seq.rawport ]
+
+
+def drain(blm):
+    '''wait until everything decoded so far has been flushed and sent'''
+    blm.flush()
+    for pad in blm.pad:
+        pad.rawport.drain()
+    blm.seq.rawport.drain()
+
+
+def shutdown(blm):
+    blm.scheduler.stop()
+    blm.flush()
+    for pad in blm.pad:
+        pad.rawport.stop()
+    blm.seq.rawport.stop()
+
+
+# Traffic generators - each returns a list of messages for Seq.callback, or raw messages for Pad.press
+
+def rows_traffic(blm, frames, rng):
+    '''full screen repaints with the optimized row pattern transfer - green and red, both halves of all 16 rows'''
+    return [ mido.Message("control_change", channel=row, control=cc, value=rng.randrange(128))
+             for frame in range(frames) for row in range(16) for cc in (0x10, 0x11, 0x12, 0x13, 0x20, 0x21, 0x22, 0x23) ]
+
+
+def cols_traffic(blm, frames, rng):
+    '''full screen repaints with the 90 degree rotated column pattern transfer'''
+    return [ mido.Message("control_change", channel=col, control=cc, value=rng.randrange(128))
+             for frame in range(frames) for col in range(16) for cc in (0x18, 0x19, 0x1A, 0x1B, 0x28, 0x29, 0x2A, 0x2B) ]
+
+
+def leds_traffic(blm, frames, rng):
+    '''bursts of single LED note_on updates - 64 per frame'''
+    return [ mido.Message("note_on", channel=rng.randrange(16), note=rng.randrange(16), velocity=rng.choice( (0x00, 0x20, 0x40, 0x7F) ))
+             for frame in range(frames) for i in range(64) ]
+
+
+def extra_traffic(blm, frames, rng):
+    '''extra row and column updates - pattern transfers plus single LED updates'''
+    msgs = []
+    for frame in range(frames):
+        for cc in (0x40, 0x41, 0x42, 0x43, 0x48, 0x49, 0x4A, 0x4B, 0x50, 0x51, 0x52, 0x53, 0x58, 0x59, 0x5A, 0x5B, 0x60, 0x61, 0x62, 0x63, 0x68, 0x69, 0x6A, 0x6B):
+            msgs.append( mido.Message("control_change", channel=0, control=cc, value=rng.randrange(128)) )
+        for i in range(16):
+            msgs.append( mido.Message("note_on", channel=rng.randrange(16), note=0x40, velocity=rng.choice( (0x00, 0x20, 0x40, 0x7F) )) )
+            msgs.append( mido.Message("note_on", channel=0, note=0x60+rng.randrange(16), velocity=rng.choice( (0x00, 0x20, 0x40, 0x7F) )) )
+    return msgs
+
+
+def presses_traffic(blm, frames, rng):
+    '''button press storms on all pads - a press and a release on 64 random buttons per frame'''
+    buttons = [ (pad, key) for pad in blm.pad for key in pad.inputtable if key >> 8 != 0x80 ]
+    events = []
+    for frame in range(frames):
+        for i in range(64):
+            pad, key = rng.choice(buttons)
+            events.append( (pad, bytes( (key >> 8, key & 0x7F, 0x7F) )) )
+            events.append( (pad, bytes( (key >> 8, key & 0x7F, 0x00) )) )
+    return events
+
+
+scenarios = {
+    "rows": rows_traffic,
+    "cols": cols_traffic,
+    "leds": leds_traffic,
+    "extra": extra_traffic,
+    "presses": presses_traffic,
+}
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[ min( len(sorted_values) - 1, int( len(sorted_values) * p / 100.0 ) ) ]
+
+
+def drive(events, times=None):
+    '''
+    Calls handler(arg) for each (handler, arg) in events, timing each call.  If times is given, event i is
+    held back until times[i] seconds after the start, otherwise everything goes as fast as possible.
+    Returns the per event latencies and the total elapsed time.
+    '''
+    latencies = []
+    clock = time.perf_counter
+    started = clock()
+    for i, (handler, arg) in enumerate(events):
+        if times is not None:
+            wait = started + times[i] - clock()
+            if wait > 0:
+                time.sleep(wait)
+        t0 = clock()
+        handler(arg)
+        latencies.append( clock() - t0 )
+    return latencies, clock() - started
+
+
+def run(numpads, scenario, frames, max_flush_rate, driver=None, seed=0):
+    blm = build_blm(numpads, max_flush_rate, driver)
+    traffic = scenarios[scenario](blm, frames, random.Random(seed))
+    if scenario == "presses":
+        events = [ (pad.press, data) for pad, data in traffic ]
+    else:
+        events = [ (blm.seq.callback, msg) for msg in traffic ]
+
+    latencies, elapsed = drive(events)
+    shutdown(blm)
+    return result(blm, numpads, scenario, latencies, elapsed)
+
+
+def replay(filename, fast, max_flush_rate, driver=None):
+    '''feed a capture back into a BLM with the same number of pads - at recorded speed, or as fast as possible'''
+    records = list( read_capture(filename) )
+    numpads = max( [ source for t, source, data in records ] + [1] )
+    numpads = min( n for n in (1, 2, 4) if n >= numpads )
+    blm = build_blm(numpads, max_flush_rate, driver)
+
+    events = []
+    for t, source, data in records:
+        if source == Capture.SEQ:
+            events.append( (blm.seq.callback, mido.Message.from_bytes(data)) ) # parsed up front - mido does this before Seq.callback
+        else:
+            events.append( (blm.pad[source - 1].press, data) )
+
+    latencies, elapsed = drive(events, None if fast else [ t for t, source, data in records ])
+    shutdown(blm)
+    return result(blm, numpads, "replay", latencies, elapsed)
+
+
+def result(blm, numpads, scenario, latencies, elapsed):
+    latencies.sort()
+    return {
+        "layout": numpads,
+        "scenario": scenario,
+        "messages": len(latencies),
+        "rate": len(latencies) / elapsed if elapsed else 0.0,
+        "p50": percentile(latencies, 50) * 1e6,
+        "p90": percentile(latencies, 90) * 1e6,
+        "p99": percentile(latencies, 99) * 1e6,
+        "max": latencies[-1] * 1e6 if latencies else 0.0,
+        "ports": [ (port.name, port.messages, port.bytes, writer.dropped) for port, writer in zip( ports(blm), writers(blm) ) ],
+    }
+
+
+def report(result):
+    print( "%i pad%s %-8s %8i msgs %10.0f msg/s   latency us p50 %6.1f  p90 %6.1f  p99 %6.1f  max %8.1f" % (
+        result["layout"], " " if result["layout"] == 1 else "s", result["scenario"], result["messages"], result["rate"],
+        result["p50"], result["p90"], result["p99"], result["max"] ) )
+    for name, messages, nbytes, dropped in result["ports"]:
+        print( "        %-12s %8i msgs %9i bytes %8i dropped" % (name, messages, nbytes, dropped) )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="pyBLM synthetic load benchmark")
+    parser.add_argument("--layouts", type=int, nargs="+", default=[1, 2, 4], choices=[1, 2, 4], help="number of pads (default: 1 2 4)")
+    parser.add_argument("--scenarios", nargs="+", default=list(scenarios), choices=list(scenarios), help="traffic to generate (default: all)")
+    parser.add_argument("--frames", type=int, default=200, help="full screen frames / bursts per scenario (default: %(default)s)")
+    parser.add_argument("--flush-rate", type=float, default=100, help="maximum LED flush rate in Hz (default: %(default)s)")
+    parser.add_argument("--driver", default="classic", choices=[ driver.name for driver in drivers ], help="Launchpad model to encode the LED output for (default: %(default)s)")
+    parser.add_argument("--replay", metavar="FILE", help="replay a capture recorded with pyBLM.py --capture instead of generating traffic")
+    parser.add_argument("--fast", action="store_true", help="replay as fast as possible instead of at recorded speed")
+    args = parser.parse_args()
+    driver = { driver.name: driver for driver in drivers }[args.driver]
+
+    if args.replay:
+        report( replay(args.replay, args.fast, args.flush_rate, driver) )
+        sys.exit()
+
+    for numpads in args.layouts:
+        for scenario in args.scenarios:
+            report( run(numpads, scenario, args.frames, args.flush_rate, driver) )
@@ -0,0 +1,462 @@
+#!/usr/bin/env python3
+'''
+Software Launchpads and a software MIDIbox SEQ for running pyBLM without hardware.
+
+The emulators sit on an in-memory mido backend - this module is the backend.  install() switches mido (and pyBLM,
+which honours MIDO_BACKEND) over to it, after which every emulator shows up as MIDI ports with the names the real
+devices have, and pyBLM finds, sets up and drives them exactly as it would the hardware.
+
+    ./emulators.py --pads 4 --seconds 10 --rate 100
+
+runs the whole engine - interactive setup included - under a sustained pattern stream from the emulated SEQ, and
+reports throughput and whether the emulated pads ended up showing what the SEQ sent.
+'''
+
+import argparse, collections, os, queue, random, sys, threading, time
+import mido
+import mido.ports
+
+
+BACKEND = "emulators"
+
+
+class Endpoint(dict):
+    '''
+    The device end of an in-memory MIDI port.  Whatever pyBLM sends to the output port with this name is passed to
+    receive(data), send(data) delivers to every input port pyBLM has open with this name.
+    '''
+
+    def __init__(self, name, receive):
+        dict.__init__(self)
+        self.__dict__ = self
+        self.name = name
+        self.receive = receive
+        self.inputs = [] # open Input ports
+        self.lock = threading.Lock()
+
+    def send(self, data):
+        with self.lock:
+            inputs = list(self.inputs)
+        for port in inputs:
+            port.deliver(data)
+
+    def listening(self):
+        '''True once pyBLM has a callback on one of the input ports'''
+        with self.lock:
+            return any( port.callback is not None for port in self.inputs )
+
+
+endpoints = collections.OrderedDict() # port name -> Endpoint
+endpoints_lock = threading.Lock()
+
+
+def add_endpoint(name, receive):
+    with endpoints_lock:
+        endpoints[name] = Endpoint(name, receive)
+        return endpoints[name]
+
+
+def remove_endpoint(name):
+    with endpoints_lock:
+        endpoints.pop(name, None)
+
+
+def find_endpoint(name):
+    with endpoints_lock:
+        endpoint = endpoints.get(name)
+    if endpoint is None:
+        raise OSError("unknown port %r" % name)
+    return endpoint
+
+
+# mido backend interface
+
+def get_devices(**kwargs):
+    with endpoints_lock:
+        return [ { "name": name, "is_input": True, "is_output": True } for name in endpoints ]
+
+
+class Input(mido.ports.BaseInput):
+    '''
+    Input port on the in-memory backend.  Like rtmidi, messages arrive on a thread of their own -
+    each port has one, which calls the callback or queues the message for receive().
+    '''
+
+    def _open(self, callback=None, **kwargs):
+        self.endpoint = find_endpoint(self.name)
+        self.callback = callback
+        self.pending = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self.run, name="emulated input %s" % self.name, daemon=True)
+        self.thread.start()
+        with self.endpoint.lock:
+            self.endpoint.inputs.append(self)
+
+    def _close(self):
+        with self.endpoint.lock:
+            if self in self.endpoint.inputs:
+                self.endpoint.inputs.remove(self)
+        self.pending.put(None)
+
+    def deliver(self, data):
+        self.pending.put(data)
+
+    def run(self):
+        while True:
+            data = self.pending.get()
+            if data is None:
+                return
+            msg = mido.Message.from_bytes(data)
+            callback = self.callback
+            if callback is not None:
+                callback(msg)
+            else:
+                with self._lock:
+                    self._messages.append(msg)
+
+
+class Output(mido.ports.BaseOutput):
+    '''Output port on the in-memory backend.  Has an rtmidi style send_message, so pyBLM's RawOutput sends raw bytes'''
+
+    def _open(self, **kwargs):
+        self.endpoint = find_endpoint(self.name)
+        self._send_lock = threading.RLock()
+
+    def _send(self, msg):
+        self.endpoint.receive(msg.bytes())
+
+    def send_message(self, data):
+        self.endpoint.receive(data)
+
+
+def install():
+    '''use the in-memory backend - for mido, and for pyBLM when it's imported afterwards'''
+    os.environ["MIDO_BACKEND"] = BACKEND
+    mido.set_backend(BACKEND)
+
+
+
+class LaunchpadEmulator(dict):
+    '''
+    A classic Launchpad (Launchpad S protocol).  Keeps the colour of every LED in both display buffers, following
+    single LED messages, rapid LED update, double buffering and resets.  press/release inject button events.
+
+    LEDs are kept by slot - the grid left to right and top to bottom, then the round buttons on the right from top
+    to bottom, then the round buttons on top from left to right, as in pyBLM's Pad.slots.
+    '''
+    NUMSLOTS = 80
+
+    def __init__(self, name="Launchpad S", client=24, scroll_done=True):
+        dict.__init__(self)
+        self.__dict__ = self
+        self.name = "%s:%s MIDI 1 %i:0" % (name, name, client)
+        self.scroll_done = scroll_done # answer scrolling text with the "done scrolling" message, like the hardware
+        self.lock = threading.Lock()
+        self.buffers = [ bytearray(self.NUMSLOTS), bytearray(self.NUMSLOTS) ]
+        self.displayed = 0 # buffer shown
+        self.updated = 0 # buffer LED messages write to
+        self.cursor = 0 # rapid LED update position
+        self.brightness = None
+        self.text = None # last scrolled text
+        self.received = 0 # messages
+        self.received_bytes = 0
+        self.endpoint = add_endpoint(self.name, self.receive)
+
+    def close(self):
+        remove_endpoint(self.name)
+
+    # LED state
+
+    @staticmethod
+    def slot(status, address):
+        '''slot of a note/CC LED address, None if there's no such LED'''
+        if status == 0xB0:
+            return 72 + address - 104 if 104 <= address <= 111 else None
+        row, col = address >> 4, address & 0x0F
+        if row > 7 or col > 8:
+            return None
+        return 64 + row if col == 8 else row * 8 + col
+
+    def leds(self):
+        '''the colours the Launchpad is showing, by slot'''
+        with self.lock:
+            return bytes(self.buffers[self.displayed])
+
+    def grid(self):
+        '''8 rows of 8 grid colours, as shown'''
+        leds = self.leds()
+        return [ list(leds[row*8:row*8+8]) for row in range(8) ]
+
+    def receive(self, data):
+        '''decode a message from pyBLM into the LED state'''
+        with self.lock:
+            self.received += 1
+            self.received_bytes += len(data)
+            status = data[0]
+            update = self.buffers[self.updated]
+
+            if status == 0x92:
+                # rapid LED update - two LEDs at the cursor
+                if self.cursor < self.NUMSLOTS:
+                    update[self.cursor] = data[1]
+                    update[self.cursor + 1] = data[2]
+                self.cursor = (self.cursor + 2) % self.NUMSLOTS
+
+            elif status in (0x90, 0x80):
+                slot = self.slot(0x90, data[1])
+                if slot is not None:
+                    update[slot] = data[2] if status == 0x90 else 0
+
+            elif status == 0xB0:
+                control, value = data[1], data[2]
+                if control == 0:
+                    if value == 0:
+                        # reset - all LEDs off, buffer 0 shown and updated
+                        self.buffers = [ bytearray(self.NUMSLOTS), bytearray(self.NUMSLOTS) ]
+                        self.displayed = self.updated = self.cursor = 0
+                    elif value in (1, 2):
+                        self.cursor = 0 # selecting a layout resets the rapid update cursor
+                    elif 0x20 <= value <= 0x3D:
+                        self.displayed = value & 1
+                        self.updated = (value >> 2) & 1
+                        if value & 0x10:
+                            self.buffers[self.updated][:] = self.buffers[self.displayed]
+                    elif value in (125, 126, 127):
+                        level = value - 124
+                        self.buffers[self.displayed][:] = bytes( [level | (level << 4)] * self.NUMSLOTS )
+                elif control == 30:
+                    self.brightness = value
+                else:
+                    slot = self.slot(0xB0, control)
+                    if slot is not None:
+                        update[slot] = value
+
+            elif status == 0xF0 and list(data[1:5]) == [ 0, 32, 41, 9 ]:
+                text = bytes(data[6:-1])
+                self.text = text if text else None
+                if text and self.scroll_done:
+                    self.endpoint.send( [0xB0, 0, 3] )
+
+    # buttons
+
+    def press(self, row, col, velocity=0x7F):
+        '''press a grid button - row 8 is the round buttons on top, col 8 the round buttons on the right'''
+        if row == 8:
+            self.endpoint.send( [0xB0, 104 + col, velocity] )
+        else:
+            self.endpoint.send( [0x90, row * 16 + col, velocity] )
+
+    def release(self, row, col):
+        self.press(row, col, 0)
+
+    def tap(self, row, col):
+        self.press(row, col)
+        self.release(row, col)
+
+
+
+class SeqEmulator(dict):
+    '''
+    A MIDIbox SEQ V4 with its four USB ports.  On the BLM port it answers pings for its device ID, takes the
+    layout pyBLM sends, counts button presses, and sends LED patterns.  It keeps its own 16x16 model of the LEDs
+    it has sent, to check the pads against.
+    '''
+
+    COLORS = ( 0, 3, 48, 51 ) # classic Launchpad off, red, green, orange - indexed by (green << 1) | red
+
+    def __init__(self, blm_port=1, device_id=0, client=20):
+        dict.__init__(self)
+        self.__dict__ = self
+        self.blm_port = blm_port
+        self.device_id = device_id
+        self.layout = None # (rows, cols, colours, extra rows, extra columns, extra buttons) from pyBLM
+        self.presses = 0
+        self.buttons = {} # (channel, note) -> last velocity
+        self.sent = 0
+        self.red = [ [0] * 16 for row in range(16) ]
+        self.green = [ [0] * 16 for row in range(16) ]
+        self.lock = threading.Lock()
+        self.streaming = None
+        self.names = {}
+        for num in (1, 2, 3, 4):
+            self.names[num] = "MIDIbox SEQ V4:MIDIbox SEQ V4 MIDI %i %i:%i" % (num, client, num - 1)
+            add_endpoint(self.names[num], lambda data, num=num: self.receive(num, data))
+
+    def close(self):
+        self.stop_stream()
+        for name in self.names.values():
+            remove_endpoint(name)
+
+    def receive(self, portnum, data):
+        if portnum != self.blm_port:
+            return
+        if data[0] == 0xF0 and list(data[1:5]) == [ 0x00, 0x00, 0x7E, 0x4E ]:
+            if data[5] != self.device_id or len(data) < 8:
+                return
+            if data[6] == 0x0F and len(data) == 8:
+                # ping - answer it
+                self.send( [ 0xF0, 0x00, 0x00, 0x7E, 0x4E, self.device_id, 0x0F, 0x00, 0xF7 ] )
+            elif data[6] == 0x01:
+                self.layout = tuple(data[7:-1])
+        elif data[0] & 0xF0 == 0x90:
+            with self.lock:
+                self.presses += 1
+                self.buttons[ (data[0] & 0x0F, data[1]) ] = data[2]
+
+    def send(self, data):
+        with self.lock:
+            self.sent += 1
+        endpoints[ self.names[self.blm_port] ].send(data)
+
+    def request_layout(self):
+        self.send( [ 0xF0, 0x00, 0x00, 0x7E, 0x4E, 0x00, 0x00, 0xF7 ] )
+
+    # LED output
+
+    def set_led(self, row, col, red, green):
+        '''single LED update'''
+        self.red[row][col] = red
+        self.green[row][col] = green
+        self.send( [ 0x90 | row, col, (red << 6) | (green << 5) | (0x1F if red and green else 0) ] )
+
+    def send_rows(self, rng):
+        '''a full 16x16 frame of random patterns, in the optimized row transfer protocol'''
+        for row in range(16):
+            for plane, base in ( (self.green, 0x10), (self.red, 0x20) ):
+                for half in (0, 1):
+                    bits = rng.randrange(256)
+                    for i in range(8):
+                        plane[row][half*8 + i] = (bits >> i) & 1
+                    self.send( [ 0xB0 | row, base + half * 2 + (bits >> 7), bits & 0x7F ] )
+
+    def send_cols(self, rng):
+        '''a full 16x16 frame of random patterns, in the 90 degree rotated column transfer protocol'''
+        for col in range(16):
+            for plane, base in ( (self.green, 0x18), (self.red, 0x28) ):
+                for half in (0, 1):
+                    bits = rng.randrange(256)
+                    for i in range(8):
+                        plane[half*8 + i][col] = (bits >> i) & 1
+                    self.send( [ 0xB0 | col, base + half * 2 + (bits >> 7), bits & 0x7F ] )
+
+    def stream(self, rate, seed=0):
+        '''send random row and column frames at rate frames per second, until stop_stream'''
+        self.stop_stream()
+        stop = threading.Event()
+        def run():
+            rng = random.Random(seed)
+            interval = 1.0 / rate
+            due = time.monotonic()
+            while not stop.is_set():
+                (self.send_rows if rng.random() < 0.5 else self.send_cols)(rng)
+                due += interval
+                stop.wait( max(0, due - time.monotonic()) )
+        self.streaming = ( stop, threading.Thread(target=run, name="emulated SEQ stream", daemon=True) )
+        self.streaming[1].start()
+
+    def stop_stream(self):
+        if self.streaming is not None:
+            stop, thread = self.streaming
+            stop.set()
+            thread.join()
+            self.streaming = None
+
+    def expected(self, row, col):
+        '''the Launchpad colour the BLM should show at row/col'''
+        return self.COLORS[ self.red[row][col] | (self.green[row][col] << 1) ]
+
+
+
+def wait_for(condition, timeout=10, interval=0.01):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise TimeoutError("emulated devices timed out waiting for pyBLM")
+        time.sleep(interval)
+
+
+def set_up(blm, pads, seq):
+    '''
+    Runs pyBLM's interactive setup against the emulators, pressing the buttons a user would -
+    a grid button on each pad in order, then the SEQ BLM port button.
+    '''
+    def user():
+        for pad in pads:
+            wait_for(pad.endpoint.listening)
+            pad.tap(3, 3)
+            wait_for( lambda: pad.text is not None ) # pad number scrolling - pyBLM has taken it
+        pads[0].tap(8, seq.blm_port - 1)
+
+    presser = threading.Thread(target=user, name="emulated user", daemon=True)
+    presser.start()
+    blm.connect()
+    presser.join()
+
+
+def run(numpads, seconds, rate, max_flush_rate=100):
+    '''run the full engine against emulators under a sustained pattern stream.  Returns a dict of results'''
+    install()
+    import pyBLM
+
+    seq = SeqEmulator()
+    pads = [ LaunchpadEmulator("Launchpad S %i" % i, 24 + i) for i in range(numpads) ]
+
+    blm = pyBLM.pyBLM(max_flush_rate, run=False, layout_cache=None)
+    set_up(blm, pads, seq)
+    blm.grid_config()
+    blm.set_callbacks()
+    keepalive = threading.Thread(target=blm.mainloop, name="keepalive", daemon=True)
+    keepalive.start()
+    wait_for( lambda: seq.layout is not None )
+
+    for pad in pads:
+        pad.received = pad.received_bytes = 0
+    seq.sent = 0
+    started = time.monotonic()
+    seq.stream(rate)
+    time.sleep(seconds)
+    seq.stop_stream()
+    elapsed = time.monotonic() - started
+
+    # let the last frame through, then compare every BLM LED with what the SEQ sent
+    time.sleep( 0.2 + 2.0 / max_flush_rate )
+    for pad in blm.pad:
+        pad.rawport.drain()
+    time.sleep(0.05)
+    emulated = { pad.name: pad for pad in pads }
+    mismatches = 0
+    for row in range(blm.numrows):
+        for col in range(blm.numcols):
+            i = row * 16 + col
+            pad = blm.pad[ blm.ledmap.pad[i] ]
+            if emulated[pad.name].leds()[ blm.ledmap.slot[i] ] != seq.expected(row, col):
+                mismatches += 1
+
+    return {
+        "pads": numpads,
+        "seconds": elapsed,
+        "seq messages": seq.sent,
+        "pad messages": sum( pad.received for pad in pads ),
+        "pad bytes": sum( pad.received_bytes for pad in pads ),
+        "mismatches": mismatches,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="run pyBLM against emulated Launchpads and an emulated SEQ")
+    parser.add_argument("--pads", type=int, default=4, choices=[1, 2, 4], help="number of emulated Launchpads (default: %(default)s)")
+    parser.add_argument("--seconds", type=float, default=10, help="how long to stream patterns for (default: %(default)s)")
+    parser.add_argument("--rate", type=float, default=100, help="full 16x16 frames per second from the SEQ (default: %(default)s)")
+    parser.add_argument("--flush-rate", type=float, default=100, help="pyBLM's maximum LED flush rate in Hz (default: %(default)s)")
+    args = parser.parse_args()
+
+    result = run(args.pads, args.seconds, args.rate, args.flush_rate)
+    print( "%i pads, %.1f s: SEQ sent %i messages (%.0f/s), pads received %i messages (%.0f/s, %i bytes), %i LEDs differ from the SEQ" % (
+        result["pads"], result["seconds"], result["seq messages"], result["seq messages"] / result["seconds"],
+        result["pad messages"], result["pad messages"] / result["seconds"], result["pad bytes"], result["mismatches"] ) )
+    sys.exit(1 if result["mismatches"] else 0)
+
+
+if __name__ == "__main__":
+    # mido imports the backend as the emulators module - run from that, not from __main__, so there's one set of endpoints
+    import emulators
+    emulators.main()
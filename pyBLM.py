@@ -1,248 +1,815 @@
 #!/usr/bin/env python3
 
-import logging, mido, re, time, sys
-from numpy import rot90
+import time
+import_started = time.perf_counter() # start of the startup profile
 
-mido.set_backend('mido.backends.rtmidi')
+import argparse, atexit, bisect, collections, itertools, json, logging, logging.handlers, mido, os, queue, re, selectors, signal, socket, struct, threading, sys
+# asyncio and concurrent.futures are slow to import - they're imported once, by the code that sets up what needs them
+
+mido.set_backend( os.environ.get('MIDO_BACKEND', 'mido.backends.rtmidi') ) # MIDO_BACKEND=emulators runs on emulated devices
 
 # set up logging
-logging.basicConfig(filename="pyBLM.log", filemode="w", level=logging.INFO,  format='%(asctime)s %(message)s')
+# records are queued, and a listener thread does the file and stdout I/O - so logging never blocks an rtmidi callback
+# PYBLM_LOG names the log file - set per worker by the supervisor, so several BLMs don't share one.
+# The file is only opened by the first record, so --log-file can replace it before pyBLM.log is ever touched.
+# Worker logs are appended to - the supervisor restarts a worker that died, and its log has to say why
+log_filehandler = logging.FileHandler(os.environ.get("PYBLM_LOG", "pyBLM.log"), mode="a" if "PYBLM_LOG" in os.environ else "w", delay=True)
+log_filehandler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+log_streamhandler = logging.StreamHandler() # also output log msgs to stdout
+log_streamhandler.addFilter(logging.Filter("log_pyblm"))
+log_queue = queue.SimpleQueue()
+log_queuehandler = logging.handlers.QueueHandler(log_queue)
+log_queuehandler.setFormatter(logging.Formatter('%(message)s')) # the listener's handlers add the timestamp
+logging.basicConfig(level=logging.INFO, handlers=[ log_queuehandler ])
+log_listener = logging.handlers.QueueListener(log_queue, log_filehandler, log_streamhandler, respect_handler_level=True)
+log_listener.start()
+atexit.register( lambda: log_listener.stop() ) # write out whatever is still queued
+
 log = logging.getLogger("log_pyblm")
-log.addHandler(logging.StreamHandler()) # also output log msgs to stdout
-log.error('pyBLM launched.')
+
+
+def set_logfile(filename):
+    '''log to filename from now on, instead of pyBLM.log'''
+    global log_filehandler, log_listener
+    log_listener.stop()
+    log_filehandler.close()
+    log_filehandler = logging.FileHandler(filename, mode="w", delay=True)
+    log_filehandler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+    log_listener = logging.handlers.QueueListener(log_queue, log_filehandler, log_streamhandler, respect_handler_level=True)
+    log_listener.start()
 
 logmidi = logging.getLogger("log_pyblm.midi") # using this too keep the torrent of MIDI messages separate so they can easily be filtered
 
 
 
+class Histogram(dict):
+    '''
+    Fixed bucket latency histogram.  bounds are the bucket upper limits in microseconds, the last bucket is open ended.
+    Updates aren't locked - counts from concurrent threads are approximate.
+    '''
+
+    bounds = ( 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 20000, 50000, 100000, 200000, 500000, 1000000 )
+
+    def __init__(self):
+        dict.__init__(self)
+        self.__dict__ = self
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0 # microseconds
+        self.max = 0.0
+
+    def record(self, us):
+        self.counts[ bisect.bisect_left(self.bounds, us) ] += 1
+        self.count += 1
+        self.total += us
+        if us > self.max:
+            self.max = us
+
+    def percentile(self, p):
+        '''upper bound of the bucket holding the p-th percentile'''
+        target = self.count * p / 100.0
+        seen = 0
+        for bound, count in zip( self.bounds + (self.max,), self.counts ):
+            seen += count
+            if seen >= target:
+                return min(bound, self.max)
+        return self.max
+
+
+class Stats(dict):
+    '''
+    Latency histograms and message counters for the SEQ -> LED and pad -> SEQ paths.  Off by default - every
+    instrumentation point checks stats.enabled first, so it costs next to nothing until it's switched on.
+
+    Latencies are measured from the moment a message enters Seq.callback / Pad.press:
+      seq decode - decoded into the framebuffer        pad lookup - translated into the SEQ message
+      seq flush  - pad flush started                   pad sent   - SEQ port send returned
+      seq sent   - pad port send returned
+    and seq ping rtt is the round trip time of the link monitor's pings.
+    '''
+
+    def __init__(self):
+        dict.__init__(self)
+        self.__dict__ = self
+        self.enabled = False
+        self.reset()
+
+    def reset(self):
+        self.started = time.monotonic()
+        self.histograms = collections.OrderedDict() # name -> Histogram
+        self.counters = collections.OrderedDict() # name -> message count
+
+    def record(self, name, since):
+        '''record the time elapsed since the perf_counter timestamp since'''
+        self.record_us(name, (time.perf_counter() - since) * 1e6)
+
+    def record_us(self, name, us):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms.setdefault(name, Histogram())
+        histogram.record(us)
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def report(self):
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        lines = [ "pyBLM stats - %.1f s" % elapsed, "%-24s %10s %10s" % ("messages", "total", "per sec") ]
+        for name, count in list(self.counters.items()):
+            lines.append( "%-24s %10i %10.1f" % (name, count, count / elapsed) )
+
+        lines.append( "%-24s %8s %8s %8s %8s %8s %8s" % ("latency (us)", "count", "mean", "p50", "p90", "p99", "max") )
+        for name, h in list(self.histograms.items()):
+            if h.count:
+                lines.append( "%-24s %8i %8.0f %8.0f %8.0f %8.0f %8.0f" % (name, h.count, h.total / h.count, h.percentile(50), h.percentile(90), h.percentile(99), h.max) )
+                lines.append( "    " + "  ".join( "<=%i:%i" % (bound, count) for bound, count in zip(h.bounds, h.counts) if count ) + ( "  >%i:%i" % (h.bounds[-1], h.counts[-1]) if h.counts[-1] else "" ) )
+        return "\n".join(lines)
+
+    def dump(self, signum=None, frame=None):
+        '''log the report - also usable as a signal handler'''
+        log.info(self.report())
+
+
+stats = Stats()
+
+
+
+class StartupProfile(dict):
+    '''
+    Wall clock time of each startup phase, from the moment pyBLM.py started importing its modules.
+    Off by default - mark() does nothing until it's switched on with --startup-profile.
+    '''
+
+    def __init__(self, started):
+        dict.__init__(self)
+        self.__dict__ = self
+        self.enabled = False
+        self.marks = [ ("start", started) ] # (phase, perf_counter time it ended)
+
+    def mark(self, phase):
+        if self.enabled:
+            self.marks.append( (phase, time.perf_counter()) )
+
+    def report(self):
+        lines = [ "startup profile - %.1f ms" % ( (self.marks[-1][1] - self.marks[0][1]) * 1e3 ) ]
+        for (previous, start), (phase, end) in zip(self.marks, self.marks[1:]):
+            lines.append( "%-28s %8.1f ms" % (phase, (end - start) * 1e3) )
+        return "\n".join(lines)
+
+    def dump(self):
+        if self.enabled:
+            log.info(self.report())
+
+
+startup = StartupProfile(import_started)
+
+
+
+class Capture(dict):
+    '''
+    Records every message entering Seq.callback and Pad.press into a compact binary file, for replay with bench.py.
+    Off by default - like stats, the hooks check capture.enabled first.
+
+    File format: the magic b"pyBLMcap", a version byte, then one record per message:
+      uint32 microseconds since the previous record (monotonic clock), uint8 source, uint16 length, the raw MIDI bytes
+    all little endian.  Source 0 is the SEQ, 1-4 are pads 0-3.
+    '''
+    MAGIC = b"pyBLMcap"
+    VERSION = 1
+    SEQ = 0
+    record_header = struct.Struct("<IBH")
+
+    def __init__(self):
+        dict.__init__(self)
+        self.__dict__ = self
+        self.enabled = False
+        self.file = None
+        self.lock = threading.Lock() # the SEQ and the pads call in from different threads
+
+    def start(self, filename):
+        with self.lock:
+            self.file = open(filename, "wb")
+            self.file.write(self.MAGIC + bytes( (self.VERSION,) ))
+            self.last = time.monotonic_ns()
+            self.enabled = True
+        log.info("Capturing MIDI traffic to %s" % filename)
+
+    def stop(self):
+        with self.lock:
+            self.enabled = False
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def record(self, source, data):
+        with self.lock:
+            if self.file is None:
+                return
+            now = time.monotonic_ns()
+            delta = min( (now - self.last) // 1000, 0xFFFFFFFF )
+            self.last += delta * 1000 # rounding errors don't accumulate
+            self.file.write( self.record_header.pack(delta, source, len(data)) )
+            self.file.write( bytes(data) )
+
+
+def read_capture(filename):
+    '''generates (seconds since the start of the capture, source, message bytes) for each message in a capture file'''
+    with open(filename, "rb") as f:
+        header = f.read( len(Capture.MAGIC) + 1 )
+        if header[:-1] != Capture.MAGIC or header[-1] != Capture.VERSION:
+            raise ValueError("%s is not a pyBLM capture file" % filename)
+        size = Capture.record_header.size
+        us = 0
+        while True:
+            head = f.read(size)
+            if len(head) < size:
+                return
+            delta, source, length = Capture.record_header.unpack(head)
+            data = f.read(length)
+            if len(data) < length:
+                return # truncated by a crash - keep what we have
+            us += delta
+            yield us / 1e6, source, data
+
+
+capture = Capture()
+
+
+
+class Trace(dict):
+    '''
+    Ring buffer of the last size raw incoming messages, with monotonic timestamps - always on, dumped to the log
+    on SIGQUIT or an uncaught exception.  Recording is one counter step and one list store, with no lock:
+    next() on an itertools.count is atomic under the GIL, so concurrent callbacks each get their own slot.
+    Messages are stored as they arrive and only converted to hex when dumped.  Sources are numbered as in Capture,
+    plus SETUP for presses on pads that haven't been given a number yet, in the interactive setup.
+    '''
+    SETUP = -1
+
+    def __init__(self, size=4096):
+        dict.__init__(self)
+        self.__dict__ = self
+        self.size = size
+        self.clear()
+
+    def clear(self):
+        self.ring = [None] * self.size
+        self.counter = itertools.count()
+
+    def record(self, source, data):
+        self.ring[ next(self.counter) % self.size ] = ( time.monotonic_ns(), source, data )
+
+    def entries(self):
+        '''the recorded (timestamp ns, source, data) entries, oldest first'''
+        return sorted( [ entry for entry in list(self.ring) if entry is not None ], key=lambda entry: entry[0] )
+
+    def report(self):
+        entries = self.entries()
+        if not entries:
+            return "MIDI trace - empty"
+        end = entries[-1][0]
+        lines = [ "MIDI trace - last %i messages, times in ms before the newest" % len(entries) ]
+        for ns, source, data in entries:
+            if hasattr(data, "bytes"):
+                data = data.bytes() # mido message
+            name = "seq" if source == Capture.SEQ else "setup" if source == self.SETUP else "pad%i" % (source - 1)
+            lines.append( "%10.3f  %-5s %s" % ( (ns - end) / 1e6, name, bytes(data).hex(" ") ) )
+        return "\n".join(lines)
+
+    def dump(self, signum=None, frame=None):
+        '''log the trace - also usable as a signal handler'''
+        log.info(self.report())
+
+
+trace = Trace()
+
+
+def trace_exceptions():
+    '''dump the MIDI trace before any uncaught exception is reported - in the main thread, worker threads and rtmidi callbacks'''
+    def excepthook(exc_type, value, tb, hook=sys.excepthook):
+        if not issubclass(exc_type, KeyboardInterrupt):
+            trace.dump()
+        hook(exc_type, value, tb)
+
+    def thread_excepthook(args, hook=threading.excepthook):
+        trace.dump()
+        hook(args)
+
+    def unraisablehook(unraisable, hook=sys.unraisablehook):
+        trace.dump()
+        hook(unraisable)
+
+    sys.excepthook = excepthook
+    threading.excepthook = thread_excepthook
+    sys.unraisablehook = unraisablehook # exceptions raised in rtmidi callbacks end up here
+
+
+class Profiler(dict):
+    '''
+    Sampling profiler for a running BLM, switched on and off with SIGUSR1 (kill -USR1 <pid>), so it can be pointed at
+    a latency problem without a restart.  While it's on, a thread takes the stack of every other thread -
+    rtmidi callbacks, flush scheduler, port writers, publisher and main loop - every interval seconds.
+    Samples of threads parked in one of the idle functions are counted, but kept out of the hot function summary.
+
+    When it's switched off, the stacks are written to <prefix>-<pid>-<time>.folded, one "thread;caller;...;function
+    samples" line per stack - the input format of flamegraph.pl and speedscope - and the top functions are logged.
+    While it's off nothing runs and nothing is hooked - it costs nothing.
+    '''
+
+    # (file, function or Class.function) frames a thread waits in - a sample with one of these on top is idle.
+    # time.sleep leaves its caller on top, hence the main loop and the flush scheduler
+    idle = { ("threading.py", "wait"), ("threading.py", "_wait_for_tstate_lock"), ("selectors.py", "select"),
+             ("queue.py", "get"), ("handlers.py", "dequeue"), ("pyBLM.py", "mainloop"), ("pyBLM.py", "FlushScheduler.run") }
+
+    def __init__(self, prefix="pyBLM-profile", interval=0.001, top=20):
+        dict.__init__(self)
+        self.__dict__ = self
+        self.prefix = prefix
+        self.interval = interval
+        self.top = top
+        self.stopping = None # Event of the running sampler thread, None while the profiler is off
+
+    def toggle(self, signum=None, frame=None):
+        '''start or stop profiling - also usable as a signal handler'''
+        if self.stopping is None:
+            self.start()
+        else:
+            self.stop()
+
+    def start(self):
+        self.stopping = threading.Event()
+        threading.Thread(target=self.run, args=(self.stopping,), name="Profiler", daemon=True).start()
+        log.info("Profiler started - sampling every %.1f ms" % (self.interval * 1e3))
+
+    def stop(self):
+        '''tell the sampler to stop - it writes the profile and the summary itself, so a signal handler returns at once'''
+        self.stopping.set()
+        self.stopping = None
+
+    def run(self, stopping):
+        me = threading.get_ident()
+        stacks = collections.Counter() # (thread name, outermost frame, ..., innermost frame) -> samples
+        started = time.monotonic()
+        while not stopping.wait(self.interval):
+            names = { thread.ident: thread.name for thread in threading.enumerate() }
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append( "%s:%s" % (os.path.basename(code.co_filename), getattr(code, "co_qualname", code.co_name)) ) # Class.method on 3.11+
+                    frame = frame.f_back
+                stack.append( names.get(ident, "thread %i" % ident) ) # threads rtmidi made have no name
+                stacks[ tuple(reversed(stack)) ] += 1
+        elapsed = time.monotonic() - started
+
+        filename = "%s-%i-%s.folded" % (self.prefix, os.getpid(), time.strftime("%Y%m%d-%H%M%S"))
+        with open(filename, "w") as f:
+            for stack, count in stacks.most_common():
+                f.write( "%s %i\n" % (";".join(stack), count) )
+        log.info(self.report(stacks, elapsed, filename))
+
+    def is_idle(self, function):
+        filename, name = function.split(":", 1)
+        return (filename, name) in self.idle or (filename, name.rpartition(".")[2]) in self.idle
+
+    def report(self, stacks, elapsed, filename):
+        '''the functions the busy samples were in (self) or under (total)'''
+        own = collections.Counter()
+        total = collections.Counter()
+        busy = idle = 0
+        for stack, count in stacks.items():
+            if len(stack) < 2 or self.is_idle(stack[-1]):
+                idle += count
+                continue
+            busy += count
+            own[ stack[-1] ] += count
+            for function in set(stack[1:]):
+                total[function] += count
+
+        percent = 100.0 / max(busy, 1)
+        lines = [ "profile - %.1f s, %i busy and %i idle samples, written to %s" % (elapsed, busy, idle, filename),
+                  "%7s %7s  %s" % ("self", "total", "function") ]
+        for function, count in own.most_common(self.top):
+            lines.append( "%6.1f%% %6.1f%%  %s" % (count * percent, total[function] * percent, function) )
+        lines.append( "%7s %7s  %s" % ("", "total", "function - including callees") )
+        for function, count in total.most_common(self.top):
+            lines.append( "%6s  %6.1f%%  %s" % ("", count * percent, function) )
+        return "\n".join(lines)
+
+
+profiler = Profiler()
+
+
+
+def set_raw_callback(inport, raw_callback, callback):
+    '''
+    Installs an input callback on a mido input port.  rtmidi ports get raw_callback installed on the rtmidi MidiIn
+    itself, skipping mido's message parsing.  Ports from other backends get the regular mido callback.
+    '''
+    rt = getattr(inport, "_rt", None)
+    if rt is not None and hasattr(rt, "set_callback"):
+        rt.cancel_callback()
+        rt.set_callback(raw_callback)
+    else:
+        inport.callback = callback
+
+
+class RawOutput(dict):
+    '''
+    Fast output path.  Sends pre-encoded MIDI bytes straight to the rtmidi port underneath a mido output port,
+    skipping mido.Message construction, validation and serialization.  Ports that have an rtmidi style
+    send_message(data) method themselves are used the same way.
+    Ports from other mido backends fall back to sending a mido.Message.
+    '''
+    def __init__(self, port):
+        dict.__init__(self)
+        self.__dict__ = self
+        self.port = port
+
+        rt = getattr(port, "_rt", port)
+        if hasattr(rt, "send_message"):
+            self.rtsend = rt.send_message
+            self.lock = getattr(port, "_send_lock", None) or threading.RLock() # share mido's lock, mido sends still happen during setup
+            self.send = self.send_rtmidi
+        else:
+            self.send = self.send_mido
+
+    def send_rtmidi(self, data):
+        with self.lock:
+            self.rtsend(data)
+
+    def send_mido(self, data):
+        self.port.send(mido.Message.from_bytes(data))
+
+
+def close_ports(device):
+    '''close a Seq's or Pad's ports once they've gone - its port writer discards what it's sent until they're reopened'''
+    device.rawport.rawport = None
+    for port in (device.inport, device.outport):
+        try:
+            port.close()
+        except Exception:
+            pass # the device is gone - there's nothing left to close on it
+    device.inport = device.outport = None
+
+
+def reopen_ports(device, name):
+    '''open a Seq's or Pad's ports again, under the name they have now, and point its port writer at them'''
+    device.name = name
+    device.outport = mido.open_output(name, autoreset=True)
+    device.inport = mido.open_input(name)
+    device.rawport.rawport = RawOutput(device.outport)
+
+
+def port_base(name):
+    '''a port name without its ALSA client:port numbers, which change when devices are plugged in again or rebooted'''
+    return re.sub(" [0-9]+:[0-9]+$", "", name)
+
+
+def port_numbers(name):
+    '''the ALSA (client, port) numbers at the end of a port name, (-1, -1) if it has none'''
+    match = re.search(" ([0-9]+):([0-9]+)$", name)
+    return ( int(match.group(1)), int(match.group(2)) ) if match else (-1, -1)
+
+
+def find_port(name, names):
+    '''
+    the port called name, or else the one called the same but for its ALSA client:port numbers - the lowest numbered
+    one, if several are.  Identical devices can't be told apart by name: when that matters, check with is_ambiguous first
+    '''
+    if name in names:
+        return name
+    base = port_base(name)
+    for other in sorted(names, key=port_numbers):
+        if port_base(other) == base:
+            return other
+    return None
+
+
+def is_ambiguous(name, names):
+    '''True if the port called name has gone, and more than one port in names is called the same but for its numbers'''
+    if name in names:
+        return False
+    base = port_base(name)
+    return sum( 1 for other in names if port_base(other) == base ) > 1
+
+
+class PortWriter(threading.Thread):
+    '''
+    Writer thread for one output port.  send() only queues the message, so a slow or stalled USB endpoint
+    delays nothing but its own writer thread.
+
+    The queue holds at most maxsize messages.  When it's full, overflow decides what happens:
+    "drop_oldest" discards the oldest queued message, "drop_newest" discards the new one, "block" waits for room.
+    "spill" neither waits nor discards - the queue grows past maxsize, and the first message over it is logged.
+    on_drop is called (from the sending thread) whenever a message was discarded.  The markers queued by mark, drain
+    and stop aren't messages - they don't count towards maxsize and are never discarded.
+
+    rawport can be swapped while the writer runs - the link monitor does that when a device goes and comes back.
+    While it's None, messages are discarded.  A send that fails discards the rest of its batch, and the writer carries on.
+    '''
+
+    overflow_policies = ( "drop_oldest", "drop_newest", "block", "spill" )
+    markers = ( tuple, threading.Event ) # queued by mark and drain - stop queues None
+
+    def __init__(self, rawport, name, maxsize=1024, overflow="drop_oldest", on_drop=None):
+        if overflow not in self.overflow_policies:
+            raise ValueError("unknown overflow policy %s" % overflow)
+
+        threading.Thread.__init__(self, name="PortWriter %s" % name, daemon=True)
+        self.statname = "%s out" % name
+        self.rawport = rawport
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.on_drop = on_drop
+        self.dropped = 0 # number of discarded messages
+
+        self.queue = collections.deque()
+        self.queued = 0 # messages in the queue, not counting markers
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.not_full = threading.Condition(self.lock)
+
+    def send(self, data):
+        '''queue raw message bytes for sending'''
+        dropped = False
+        with self.lock:
+            if self.queued >= self.maxsize:
+                if self.overflow == "block":
+                    while self.queued >= self.maxsize:
+                        self.not_full.wait()
+                elif self.overflow == "drop_newest":
+                    self.dropped += 1
+                    dropped = True
+                elif self.overflow == "spill":
+                    if self.queued == self.maxsize:
+                        log.error("%s: more than %i messages queued - the port is stalled" % (self.name, self.maxsize))
+                else:
+                    # the oldest message - skipping any markers in front of it
+                    queue = self.queue
+                    i = 0
+                    while queue[i] is None or queue[i].__class__ in self.markers:
+                        i += 1
+                    del queue[i]
+                    self.queued -= 1
+                    self.dropped += 1
+                    dropped = True
+
+            if not dropped or self.overflow == "drop_oldest":
+                self.queue.append(data)
+                self.queued += 1
+                self.not_empty.notify()
+
+        if dropped:
+            if stats.enabled:
+                stats.count("%s dropped" % self.name)
+            if self.on_drop:
+                self.on_drop()
+
+    def mark(self, since, name):
+        '''
+        Queue a latency marker - when the writer gets to it, everything queued before it has been sent,
+        and the time since the perf_counter timestamp since is recorded in the stats histogram name.
+        '''
+        with self.lock:
+            self.queue.append( (since, name) )
+            self.not_empty.notify()
+
+    def drain(self, timeout=None):
+        '''wait until everything queued so far has been sent.  Returns False on timeout'''
+        done = threading.Event()
+        with self.lock:
+            self.queue.append(done)
+            self.not_empty.notify()
+        return done.wait(timeout)
+
+    def stop(self):
+        '''send everything already queued, then end the thread'''
+        with self.lock:
+            self.queue.append(None)
+            self.not_empty.notify()
+        self.join()
+
+    def run(self):
+        while True:
+            with self.lock:
+                while not self.queue:
+                    self.not_empty.wait()
+                batch = list(self.queue)
+                self.queue.clear()
+                self.queued = 0
+                self.not_full.notify_all()
+
+            rawport = self.rawport
+            send = rawport.send if rawport is not None else None
+            sent = 0
+            for data in batch:
+                if data is None:
+                    return
+                elif data.__class__ is tuple:
+                    stats.record(data[1], data[0])
+                elif data.__class__ is threading.Event:
+                    data.set()
+                elif send is not None:
+                    try:
+                        send(data)
+                        sent += 1
+                    except Exception as e:
+                        # the device has most likely gone - the link monitor will notice and reopen it
+                        log.error("%s: send failed - %s" % (self.name, e))
+                        send = None
+
+            if stats.enabled:
+                stats.count(self.statname, sent)
+
+
+class OutputBudget(dict):
+    '''
+    Token bucket for one device's output - rate USB MIDI packets per second, in bursts of up to burst packets.
+    A USB MIDI packet carries one short message, or three bytes of a SysEx message.
+    Spending may take the tokens below zero - whatever comes next waits until they're paid back.
+    '''
+    def __init__(self, rate, burst):
+        dict.__init__(self)
+        self.__dict__ = self
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def available(self):
+        '''the packets that can be sent right now'''
+        now = time.monotonic()
+        self.tokens = min( self.burst, self.tokens + (now - self.updated) * self.rate )
+        self.updated = now
+        return self.tokens
+
+    def spend(self, packets):
+        self.tokens -= packets
+
+
+
 class Seq(dict):
     '''
     Handles messages to and from the MB SEQ.
     Translates BLM Protocol into rows/columns/colours
     '''
-    def __init__(self, name, portnum, parent_blm, device_id=0):
+    def __init__(self, name, portnum, parent_blm, device_id=0, outport=None, inport=None):
         log.debug("SEQ INIT")
         dict.__init__(self)
         self.__dict__ = self
         self.parent = parent_blm
-        self.outport = mido.open_output(name, autoreset=True)
-        self.inport = mido.open_input(name)
+        self.outport = outport if outport is not None else mido.open_output(name, autoreset=True) # ports are opened by name unless they're passed in
+        self.rawport = RawOutput(self.outport)
+        self.inport = inport if inport is not None else mido.open_input(name)
 
         self.name = name
         self.portnum = portnum
         self.syx_dev_id = device_id
         self.syx_prefix = [ 0x00, 0x00, 0x7E, 0x4E, self.syx_dev_id ]
-        self.last_message = time.time() # stores the time we received the last message from the SEQ
+        self.ping_reply = tuple(self.syx_prefix) + ( 0x0F, 0x00 )
+        self.layout_request = tuple(self.syx_prefix) + ( 0x00, )
+        self.last_message = time.monotonic() # stores the time we received the last message from the SEQ
+        self.ping_sent = None # monotonic time of the last ping, until the SEQ answers it
+        self.rtt = None # round trip time of the last answered ping, in seconds
+        self.callbacks = () # input callback, installed again when the port is reopened
 
 
 
     # Outgoing message functions - to MB SEQ
+    def send(self, msg):
+        '''send a mido message - through the port writer once it's started'''
+        self.rawport.send(msg.bytes())
+
+    def start_writer(self, maxsize=1024, overflow="block"):
+        '''
+        From now on, send everything through a writer thread.  It never drops - a lost release would leave a step
+        stuck on the SEQ, and there's no resync for that - so a full queue makes the sender wait, or with overflow
+        "spill" queues past maxsize instead: the asyncio BLM sends from the event loop, which mustn't wait.
+        '''
+        self.rawport = PortWriter(self.rawport, self.name, maxsize, overflow)
+        self.rawport.start()
+
+    def listen(self, callback):
+        '''install the input callback'''
+        self.callbacks = ( callback, )
+        self.inport.callback = callback
+
+    def close_ports(self):
+        '''the ports have gone - close what's left of them.  Messages sent until they're reopened are discarded'''
+        close_ports(self)
+
+    def reopen(self, name):
+        '''open the ports again, under name - the name they have now - and reinstall the input callback'''
+        reopen_ports(self, name)
+        self.listen(*self.callbacks)
+
     def send_layout(self):
         log.debug("SENDING LAYOUT - x: %i, y: %i, c: %i, xr: %i, xc: %i, xb: %i " % (self.parent.numrows, self.parent.numcols, self.parent.numcolours, self.parent.numxrows, self.parent.numxcols, self.parent.numxbuttons))
         thedata=self.syx_prefix+[ 1, self.parent.numrows, self.parent.numcols, self.parent.numcolours, 1, self.parent.numxcols, self.parent.numxbuttons ]
         msg=mido.Message("sysex", data=thedata )
-        self.outport.send(msg)
+        self.send(msg)
 
 
     def send_ping(self):
         thedata=self.syx_prefix+[ 0x0F ]
         msg=mido.Message("sysex", data=thedata )
-        self.outport.send(msg)
+        self.ping_sent = time.monotonic()
+        self.send(msg)
         log.debug("SENT PING")
 
 
     # Incoming message functions
 
     def callback(self, msg):
+        '''handle incoming messages from the SEQ - decode them into the BLM's LedMaps, then schedule a flush of the changed LEDs'''
+        t0 = time.perf_counter() if stats.enabled else None
+        self.record_input(msg)
+        with self.parent.framelock:
+            self.decode(msg)
+        if t0 is not None:
+            self.record_decode(t0)
+        self.parent.scheduler.request()
+
+    def record_input(self, msg):
+        '''put an incoming message in the MIDI trace, and the capture if one is running - both engines call this first'''
+        trace.record(Capture.SEQ, msg)
+        if capture.enabled:
+            capture.record(Capture.SEQ, msg.bytes())
+
+    def record_decode(self, t0):
+        '''stats for a message that entered at perf_counter time t0 and has just been decoded'''
+        stats.count("seq in")
+        stats.record("seq decode", t0)
+        if self.parent.pending_since is None:
+            self.parent.pending_since = t0 # oldest message waiting for the next flush
+
+    def decode(self, msg):
         if msg.type != "sysex" and msg.type != "control_change" and msg.type != "note_on"  and msg.type != "note_off" :
             # not a message we care about, exit
             return None
 
-        #logmidi.debug("SEQ IN: %s - hex %s" % (msg, msg.hex()))
-        self.last_message = time.time() # update last message received time
+        self.last_message = time.monotonic() # update last message received time
 
         if msg.type == "sysex" :
-            if msg.data == (0,0,126,78,0,0): # SEQ has requested layout.
+            if msg.data == self.layout_request: # SEQ has requested layout.
                 self.send_layout()
                 log.debug("Sent layout - SEQ LAYOUT REQUEST")
                 return
+            if msg.data == self.ping_reply and self.ping_sent is not None:
+                self.rtt = self.last_message - self.ping_sent
+                self.ping_sent = None
+                if stats.enabled:
+                    stats.record_us("seq ping rtt", self.rtt * 1e6)
+                return
 
         # single access SEQ transfer protocol
         if msg.type == "note_on" or msg.type == "note_off" :
-            if msg.velocity == 0x00 :
-                redstate = 0
-                greenstate = 0
-            elif msg.velocity == 0x20 :
-                redstate = 0
-                greenstate = 1
-            elif msg.velocity == 0x40 :
-                redstate = 1
-                greenstate = 0
-            elif msg.velocity == 0x7F :
-                redstate = 1
-                greenstate = 1
+            # colour is encoded in the velocity - 0x00 off, 0x20 green, 0x40 red, 0x7F both
+            velocity = msg.velocity if msg.type == "note_on" else 0x00
+            redstate = (velocity >> 6) & 1
+            greenstate = (velocity >> 5) & 1
 
             if msg.note <= 0x0f :
                 # BLM16x16 LEDs
-                row = msg.channel - 0x90
-                col = msg.note
-                led = get_Led(self, row, col, "blm")
-                led.update_both(redstate, greenstate)
+                self.parent.ledmap.update_both(msg.channel, msg.note, redstate, greenstate)
                 return
 
-            elif note == 0x40 :
+            elif msg.note in (0x40, 0x41) :
                 # extra column LEDs
-                row = msg.channel - 0x90
-                col = msg.note - 0x40
-                led = get_Led(self, row, col, "xcol")
-                led.update_both(redstate, greenstate)
+                self.parent.xcolmap.update_both(msg.note - 0x40, msg.channel, redstate, greenstate)
                 return
 
             elif msg.channel == 0 and msg.note >= 0x60 and msg.note <= 0x6f :
                 # extra row LEDs
-                row = msg.channel - 0x90
-                col = msg.note - 0x40
-                led = get_Led(self, row, col, "xrow")
-                led.update_both(redstate, greenstate)
+                self.parent.xrowmap.update_both(0, msg.note - 0x60, redstate, greenstate)
                 return
 
-            elif msg.chn == 0xf and msg.note >= 0x60 and msg.note <= 0x6f :
+            elif msg.channel == 0xf and msg.note >= 0x60 and msg.note <= 0x6f :
                 #additional extra LEDs
-                row = 0
-                col = msg.note - 0x40
                 # not yet implemented - the launchpad BLM has none of these buttons
                 return
 
+            return
+
 
         # Optimized row/column pattern transfer protocols
+        # decoded with the table precomputed in pyBLM.build_cctable
         if  msg.type == "control_change" :
-            if msg.control in (0x18, 0x19, 0x1A, 0x1B):
-                logmidi.debug("OPT COL: %s - hex %s" % (msg, msg.hex()))
-
-            if msg.control in (0x10, 0x11, 0x12, 0x13):
-                logmidi.debug("OPT ROW: %s - hex %s" % (msg, msg.hex()))
-
-            if msg.channel == 0xBF and msg.control in (0x60, 0x61, 0x68, 0x69):
-                # not yet implemented - the launchpad BLM has none of these extra buttons
-
+            decoder = self.parent.cctable[msg.control]
+            if decoder is None:
                 return
 
-            # Get common reusable variables
-            flag = msg.control
-            pattern = msg.value
-
-            if flag in (0x10, 0x12, 0x20, 0x22, 0x18, 0x1A, 0x28, 0x2A, 0x40, 0x42, 0x48, 0x4A, 0x50, 0x52, 0x58, 0x5A, 0x60, 0x62, 0x68, 0x6A) :
-                lastled = 0b0
-            else:
-                lastled = 0b10000000
-
-            fullpattern = pattern + lastled
-            # convert binary encoded pattern to list of 1s and 0s - reversed, so LSB is at the start of the list
-            patternlist = reversed( [int(bit) for bit in '{0:08b}'.format(fullpattern)] )
-
-            if flag in ( 0x10, 0x11, 0x12, 0x13, 0x18, 0x19, 0x1A, 0x1B, 0x40, 0x41, 0x42, 0x43, 0x50, 0x51, 0x52, 0x53, 0x60, 0x61, 0x62, 0x63 ) :
-                color = "green"
-            else:
-                color = "red"
-
-            if flag in ( 0x10, 0x11, 0x20, 0x21, 0x18, 0x19, 0x28, 0x29, 0x40, 0x41, 0x48, 0x49, 0x50, 0x51, 0x68, 0x59, 0x60, 0x61, 0x68, 0x69 ) :
-                offset = 0
-            else:
-                offset = 8
-
-
-
-            # ROW
-            # BLM16x16 optimized LED pattern transfer (prefered usage):
-            if flag in ( 0x10, 0x11, 0x12, 0x13, 0x20, 0x21, 0x22, 0x23 ) :
-                row = msg.channel
-                fullrowlist = self.parent.ledmap[row] # get a list of LED objects in the column
-
-                if flag in ( 0x10, 0x11, 0x20, 0x21 ) :
-                    rowlist = fullrowlist[:8]
-                else:
-                    rowlist = fullrowlist[8:]
-
-                for led, colorstate in zip(rowlist, patternlist):
-                    led.update_one(color, colorstate)
-
-
-
-
-            # COLUMN
-            # BLM16x16 optimized LED pattern transfer with 90 degree rotated view
-            # (rows and columns swapped, LSB starts at top left edge!)
-            elif flag in ( 0x18, 0x19, 0x1A, 0x1B, 0x28, 0x29, 0x2A, 0x2B ) :
-                col = msg.channel
-                fullcollist = [row[col] for row in self.parent.ledmap]
-
-                if flag in ( 0x18, 0x19, 0x28, 0x29 ) :
-                    collist = fullcollist[:8]
-                else:
-                    collist = fullcollist[8:]
-
-                for led, colorstate in zip(collist, patternlist):
-                    led.update_one(color, colorstate)
-
-
-
-
-            # Extra Column #1 optimized LED pattern transfer (prefered usage):
-            # NOTE: in distance to single LED access, we always sent over the same channel!
-            elif flag in ( 0x40, 0x41, 0x42, 0x43, 0x48, 0x49, 0x4A, 0x4B ) :
-                fullcollist = self.parent.xcolmap[0]
-
-                if flag in ( 0x40, 0x41, 0x48, 0x49 ) :
-                    collist = fullcollist[:8]
-                else:
-                    collist = fullcollist[8:]
-
-                for led, colorstate in zip(collist, patternlist):
-                    led.update_one(color, colorstate)
-
-            # Extra Column #2 optimized LED pattern transfer (prefered usage):
-            # NOTE: in distance to single LED access, we always sent over the same channel!
-            elif flag in ( 0x50, 0x51, 0x52, 0x53, 0x58, 0x59, 0x5A, 0x5B ) :
-                fullcollist = self.parent.xcolmap[1]
-
-                if flag in ( 0x50, 0x51, 0x58, 0x59 ) :
-                    collist = fullcollist[:8]
-                else:
-                    collist = fullcollist[8:]
-
-                for led, colorstate in zip(collist, patternlist):
-                    led.update_one(color, colorstate)
-
-            # Extra Row optimized LED pattern transfer (prefered usage):
-            elif flag in ( 0x60, 0x61, 0x62, 0x63, 0x68, 0x69, 0x6A, 0x6B ) :
-                fullcollist = self.parent.xrowmap[0]
-
-                if flag in ( 0x60, 0x61, 0x68, 0x69 ) :
-                    collist = fullcollist[:8]
-                else:
-                    collist = fullcollist[8:]
-
-                for led, colorstate in zip(collist, patternlist):
-                    led.update_one(color, colorstate)
-
-
-
-
-    # TRANSLATION FUNCTIONS
-
-    def get_Led(self, row, col, type):
-        # uses the parent BLM's ledmaps to find the led object we want to access
-        if type == "main" :
-            led = self.parent.ledmap[row][col]
-        elif type == "xrow" :
-            led = self.parent.xrowmap[row][col]
-        elif type == "xcol" :
-            led = self.parent.xcolmap[row][col]
-        elif type == "xbut" :
-            # not yet implemented - the launchpad BLM has none of these buttons
-            return false
+            update, index, half, plane, msb = decoder
+            if index is None:
+                index = msg.channel
+            elif msg.channel == 0x0F:
+                # additional extra buttons - not yet implemented, the launchpad BLM has none of these
+                return
 
-        return led
+            update(index, half, plane, LedMap.bits[msg.value | msb])
 
 
 
@@ -268,7 +835,7 @@ class Pad(dict):
     midinums["xrowccs"] = [104, 105, 106, 107, 108, 109, 110, 111]
 
     padmap = {}
-    padmap[1] = [
+    padmap[1] = tuple( map(tuple, [
         midinums["gridnotes"][0:8],
         midinums["gridnotes"][8:16],
         midinums["gridnotes"][16:24],
@@ -277,12 +844,12 @@ class Pad(dict):
         midinums["gridnotes"][40:48],
         midinums["gridnotes"][48:56],
         midinums["gridnotes"][56:64]
-        ] # maps BLM row/col coordinates (with rotation) to the Launchpad NOTE_ON MIDI number
+        ]) ) # maps BLM row/col coordinates (with rotation) to the Launchpad NOTE_ON MIDI number
 
-    # rotate counterclockwise
-    padmap[0] = rot90(padmap[1])
-    padmap[2] = rot90(padmap[0])
-    padmap[3] = rot90(padmap[2])
+    # rotate counterclockwise - transpose, then reverse the row order
+    padmap[0] = tuple( zip(*padmap[1]) )[::-1]
+    padmap[2] = tuple( zip(*padmap[0]) )[::-1]
+    padmap[3] = tuple( zip(*padmap[2]) )[::-1]
 
     # Process rows and columns for rotation
     # CCs and NOTEONs will reverse for pad 0 and pad 3
@@ -291,20 +858,27 @@ class Pad(dict):
     xcolmap = {}
 
     # rot0 - pad 1
-    xcolmap[1] = list(map(lambda midinum: (0x90, midinum,), midinums["xcolnotes"]))
-    xrowmap[1] = list(map(lambda midinum: (0xB0, midinum,), midinums["xrowccs"]))
+    xcolmap[1] = tuple( (0x90, midinum) for midinum in midinums["xcolnotes"] )
+    xrowmap[1] = tuple( (0xB0, midinum) for midinum in midinums["xrowccs"] )
 
     # rot90 - pad 0 - column becomes row, row gets flipped backwards and becomes column
-    xcolmap[0] = list( reversed(xrowmap[1]) )
+    xcolmap[0] = xrowmap[1][::-1]
     xrowmap[0] = xcolmap[1]
 
     # rot180 - pad 2 - column becomes row, row gets flipped backwards and becomes column
-    xcolmap[2] = list( reversed(xcolmap[1]) )
-    xrowmap[2] = list( reversed(xrowmap[1]) )
+    xcolmap[2] = xcolmap[1][::-1]
+    xrowmap[2] = xrowmap[1][::-1]
 
     # rot270 - pad 3 - column becomes row, row gets flipped backwards and becomes column
     xcolmap[3] = xrowmap[1]
-    xrowmap[3] = list( reversed(xcolmap[1]) )
+    xrowmap[3] = xcolmap[1][::-1]
+
+    # LED slots - every LED on the pad in rapid LED update order: the 8x8 grid left to right and top to bottom,
+    # then the round buttons on the right from top to bottom, then the round buttons on top from left to right
+    slots = [ (0x90, note) for note in midinums["gridnotes"] + midinums["xcolnotes"] ] + [ (0xB0, cc) for cc in midinums["xrowccs"] ]
+    slotmap = { addr: slot for slot, addr in enumerate(slots) } # (status_byte, note/cc num) -> slot
+
+    UNKNOWN = 0xFF # shadow value for LEDs whose state on the Launchpad we don't know - never equal to a colour
 
 
     #define color constants
@@ -318,15 +892,44 @@ class Pad(dict):
     YELLOW = 40     # 0b110001
 
 
-    def __init__(self, parent_blm, name, padnum=-1):
+    def __init__(self, parent_blm, name, padnum=-1, outport=None, inport=None, driver=None):
         log.debug("Pad.init - Name: %s" % name)
         dict.__init__(self)
         self.__dict__ = self
         self.parent = parent_blm
         self.name = name
-        self.buttonmap={}
+        self.inputtable = {} # (status << 8) | note/cc num -> (release, press) SEQ note_on bytes, built by grid_config
+        self.buttons = {} # same keys -> (row, col) BLM coordinates of the button
+        self.frame = bytearray(len(self.slots)) # colour we want each LED slot to show
+        self.dirty = set() # slots changed since the last flush
+        self.urgent = set() # the interactive ones among them - sent first, whatever the output budget
+        self.shadow = bytearray( [self.UNKNOWN] * len(self.slots) ) # colour last sent to each LED slot
+        self.callbacks = () # input callbacks, installed again when the ports are reopened
+
+        self.set_padnum(padnum)
+
+        self.outport = outport if outport is not None else mido.open_output(name, autoreset=True) # ports are opened by name unless they're passed in
+        self.rawport = RawOutput(self.outport)
+        self.inport = inport if inport is not None else mido.open_input(name)
+
+        # the protocol this model speaks - chosen by port name unless a driver class is passed in
+        if driver is None:
+            driver = find_driver(name) or ClassicDriver
+        self.driver = driver(self)
+
+        # USB MIDI packets per second the pad is sent - the driver's default unless the BLM sets one, 0 for no limit
+        rate = getattr(parent_blm, "pad_rate", None)
+        if rate is None:
+            rate = self.driver.packet_rate
+        self.budget = OutputBudget(rate, 2 * self.driver.frame_cost(len(self.slots), True)) if rate else None
 
-        # fully set up pad if we know the pad number.  If not, just use the default zero rotation map
+        self.pad_setup()
+
+    def set_padnum(self, padnum):
+        '''
+        Sets the pad's position in the BLM - 0-3, which also sets its rotation.
+        If we don't know the pad number yet, just use the default zero rotation map
+        '''
         if padnum in range(4):
             self.padnum = padnum # set zero based pad number - 0-3
             self.map = self.padmap[padnum] # set MIDI map rotation
@@ -340,11 +943,6 @@ class Pad(dict):
             self.isset = False
             self.padnum = -1
 
-        self.outport = mido.open_output(name, autoreset=True)
-        self.inport = mido.open_input(name)
-
-        self.pad_setup()
-
     def pad_setup(self):
         self.pad_reset()
         self.XYlayout()
@@ -353,52 +951,106 @@ class Pad(dict):
 
 # callback
     def callback(self, msg):
-        '''handle incoming button presses on any of the Pads.  Convert to BLM protocol format, and send to SEQ'''
-        if msg.type != "control_change" and msg.type != "note_on"  and msg.type != "note_off" :
-            # not a message we care about, exit
-            return
+        '''
+        handle incoming button presses on any of the Pads.  Convert to BLM protocol format, and send to SEQ.
+        SysEx goes to press too - the newer Launchpads report a finished text scroll with one
+        '''
+        if not msg.is_meta:
+            self.press(msg.bytes())
 
-        if msg.type == "control_change" :
-            if msg.control not in Pad.midinums["xrowccs"] :
-                return
+    def rtmidi_callback(self, event, data=None):
+        '''raw rtmidi input callback - event is a (message bytes, delta time) tuple'''
+        self.press(event[0])
 
-        outmsg = False
-        addr = (msg.control+200) if (msg.type == "control_change") else msg.note
-        state = msg.value if (msg.type == "control_change") else msg.velocity
-
-        row = self.buttonmap[addr].row
-        col = self.buttonmap[addr].col
-
-        if row == 100 :
-            # it's the extra top row.
-            outmsg = mido.Message('note_on', channel=0, note=0x60+col, velocity=state)
-        elif row == 101 :
-            pass # could use this row to send special functions later.
-        elif col == 100 :
-            # it's one of the extra columns
-            outmsg = mido.Message('note_on', channel=row, note=0x40+(col-100), velocity=state)
-        elif col == 101 :
-            # it's one of the extra columns
-            outmsg = mido.Message('note_on', channel=row, note=0x50+(col-100), velocity=state)
+    def press(self, data):
+        '''
+        Translate a raw Launchpad message into the SEQ note_on for that button, using the table compiled by grid_config.
+        '''
+        t0 = time.perf_counter() if stats.enabled else None
+        if self.padnum >= 0:
+            trace.record(self.padnum + 1, data)
+            if capture.enabled:
+                capture.record(self.padnum + 1, data)
         else:
-            outmsg = mido.Message('note_on', channel=row, note=col, velocity=state)
+            trace.record(Trace.SETUP, data)
+
+        entry = self.inputtable.get( (data[0] << 8) | data[1] ) if len(data) == 3 else None
+        if entry is not None:
+            seqport = self.parent.seq.rawport
+            if t0 is None:
+                seqport.send( entry[data[2] != 0] )
+            else:
+                stats.count("pad in")
+                stats.record("pad lookup", t0)
+                seqport.send( entry[data[2] != 0] )
+                if hasattr(seqport, "mark"):
+                    seqport.mark(t0, "pad sent")
+
+        elif self.driver.scroll_done(data):
+            # the Launchpad has finished scrolling text - whatever it shows now, it isn't our frame
+            self.resync()
+
+    def map_button(self, status, address, row, col, seqstatus, seqnote):
+        '''
+        Compile the translation of one of this pad's buttons into the SEQ note_on it triggers.
+        row/col are the button's BLM coordinates - row 100 is the extra row, col 100/101 the extra columns.
+        Any press velocity is sent as 0x7F, releases (velocity 0 or note_off) as 0x00.
+        status/address are classic Launchpad ones - the driver translates them into what this model sends.
+        '''
+        status, address = self.driver.input_address(status, address)
+        release = bytes( (seqstatus, seqnote, 0x00) )
+        press = bytes( (seqstatus, seqnote, 0x7F) )
+        self.inputtable[ (status << 8) | address ] = ( release, press )
+        self.buttons[ (status << 8) | address ] = ( row, col )
+        if status == 0x90:
+            self.inputtable[ (0x80 << 8) | address ] = ( release, release )
+            self.buttons[ (0x80 << 8) | address ] = ( row, col )
+
+
+
+    def send(self, msg):
+        '''send a mido message - through the port writer once it's started'''
+        self.rawport.send(msg.bytes())
 
-        if (outmsg):
-            self.parent.seq.outport.send(outmsg)
+    def start_writer(self, maxsize=1024, overflow="drop_oldest"):
+        '''
+        From now on, send everything through a writer thread.  If the writer has to drop messages,
+        we no longer know what the Launchpad shows - resync it.
+        '''
+        self.rawport = PortWriter(self.rawport, self.name, maxsize, overflow, on_drop=self.resync)
+        self.rawport.start()
 
-        # self.buttonmap[ledaddress]=Button(row, col)
+    def listen(self, raw_callback, callback):
+        '''install the input callbacks - see set_raw_callback'''
+        self.callbacks = ( raw_callback, callback )
+        set_raw_callback(self.inport, raw_callback, callback)
 
+    def close_ports(self):
+        '''the ports have gone - close what's left of them.  Messages sent until they're reopened are discarded'''
+        close_ports(self)
 
+    def reopen(self, name):
+        '''
+        Open the ports again, under name - the name they have now - and reinstall the input callbacks.
+        The Launchpad has been off the bus, so it gets set up from scratch - the caller resyncs its LEDs.
+        '''
+        reopen_ports(self, name)
+        self.listen(*self.callbacks)
+        # not under framelock - a full port writer calls resync from here, which takes it
+        self.pad_setup()
+        with self.parent.framelock: # flush reads the shadow under it
+            self.invalidate()
 
 # Novation Launchpad Setup Functions
 
     def pad_reset(self):
         '''send launchpad a reset command - back to power on defaults'''
-        self.outport.send(mido.Message('control_change', channel=0, control=0, value=0) )
+        self.driver.reset()
+        self.shadow[:] = bytes(len(self.shadow)) # reset turns all LEDs off
 
     def XYlayout(self):
-        '''send launchpad into XY layout mode'''
-        self.outport.send(mido.Message('control_change', channel=0, control=0, value=1) )# set pad to XY mode B0h, 00h, 01
+        '''send launchpad into XY layout mode - or whatever layout the driver uses for it'''
+        self.driver.layout()
 
 
     def set_brightness(self, brightness=2):
@@ -412,17 +1064,15 @@ class Pad(dict):
         176, 30, 2 = 1/5
         176, 30, 0 = 1/3
         '''
-        self.outport.send(mido.Message('control_change', channel=0, control=30, value=brightness) )
+        self.driver.brightness(brightness)
 
 
 
     # Novation Launchpad LED Functions
     def all_leds_off(self):
-        '''turn off all LEDS on this pad'''
-        self.outport.send(mido.Message('control_change', channel=0, control=0, value=0) )
-
-        #send empty scroll message in case text is scrolling - scrolling continues through the leds_off message above
-        self.outport.send(mido.Message("sysex", data=[ 0, 32, 41, 9, 0 ] ))
+        '''turn off all LEDS on this pad, and stop any scrolling text'''
+        self.driver.leds_off()
+        self.shadow[:] = bytes(len(self.shadow))
 
 
     def all_leds_on(self, brightness=126):
@@ -430,7 +1080,17 @@ class Pad(dict):
         if brightness not in (125, 126, 127):
             brightness = 126
 
-        self.outport.send(mido.Message('control_change', channel=0, control=0, value=brightness) )
+        self.driver.leds_on(brightness)
+        self.invalidate()
+
+
+    def scroll_text(self, color, text):
+        '''
+        Scrolls text across the pad.  text is a list of ASCII codes - values 1-7 set the scroll speed.
+        The scrolling text overwrites the LEDs, so the shadow is invalid afterwards.
+        '''
+        self.driver.scroll_text(color, text)
+        self.invalidate()
 
 
     def set_ledxy(self, row, col, color):
@@ -438,14 +1098,14 @@ class Pad(dict):
         Sets the LED at specified coordinates to color.
         '''
         notenum = self.map[row][col]
-        self.outport.send(mido.Message("note_on", channel=0, note=notenum, velocity=color))
+        self.driver.led(0x90, notenum, color)
 
 
     def set_ledaddr(self, address, color):
         '''
         Sets the LED at specified notenum address to color.
         '''
-        self.outport.send(mido.Message("note_on", channel=0, note=address, velocity=color))
+        self.driver.led(0x90, address, color)
 
 
     def set_CC_ledxy(self, row, col, color, flashcolor=0):
@@ -453,14 +1113,99 @@ class Pad(dict):
         Sets the LED at specified coordinates to color.
         '''
         notenum = self.map[row][col]
-        self.outport.send(mido.Message("note_on", channel=0, note=notenum, velocity=color))
+        self.driver.led(0x90, notenum, color)
 
 
     def set_CC_ledaddr(self, address, color):
         '''
         Sets the LED at specified address to color.
         '''
-        self.outport.send(mido.Message("control_change", channel=0, control=address, value=color))
+        self.driver.led(0xB0, address, color)
+
+
+    def set_led(self, slot, color, urgent=False):
+        '''
+        Sets the colour of an LED slot in the pad's frame.  Nothing is sent until the next flush.
+        urgent slots are interactive feedback, sent ahead of bulk pattern updates.
+        '''
+        self.frame[slot] = color
+        self.dirty.add(slot)
+        if urgent:
+            self.urgent.add(slot)
+
+
+    def flush(self, since=None):
+        '''
+        Sends the LED slots changed since the last flush, encoded by the driver - rapid LED update when enough
+        of the pad has changed, addressed note_on/CC messages otherwise on the classic Launchpad.
+        since is the perf_counter time the oldest SEQ message in this flush arrived, if stats are enabled.
+
+        Urgent slots always go, first.  The rest only go once the pad's output budget covers all of them - until then
+        they stay dirty and are sent by a later flush with whatever colour they have by then, so the port writer never
+        builds up a backlog and the pad never shows part of a frame.  Returns True if slots were held back.
+        '''
+        driver, budget = self.driver, self.budget
+        with self.parent.framelock:
+            # only send slots whose colour differs from what the Launchpad is showing.  Take a snapshot of them,
+            # so the SEQ callback can keep drawing while we send
+            frame = bytes(self.frame)
+            shadow = self.shadow
+            urgent = [ slot for slot in self.urgent if frame[slot] != shadow[slot] ]
+            bulk = [ slot for slot in self.dirty if frame[slot] != shadow[slot] and slot not in self.urgent ]
+            self.urgent = set()
+            held = []
+
+            rapid = len(urgent) + len(bulk) >= driver.rapid_threshold
+            if budget is not None and bulk and driver.frame_cost(len(urgent) + len(bulk), rapid) > budget.available():
+                # hold the bulk back whole - sending what fits would drop to one LED per message just when
+                # the pad is busiest, and show it a torn frame
+                held, bulk = bulk, []
+                rapid = False
+            self.dirty = set(held)
+
+            changes = urgent + bulk
+            if rapid:
+                shadow[:] = frame
+            else:
+                for slot in changes:
+                    shadow[slot] = frame[slot]
+
+        if held and stats.enabled:
+            stats.count("%s held back" % self.name, len(held))
+
+        if not changes:
+            return bool(held)
+
+        if budget is not None:
+            budget.spend( driver.frame_cost(len(changes), rapid) )
+        driver.send_frame(frame, changes, rapid)
+
+        if since is not None and hasattr(self.rawport, "mark"):
+            self.rawport.mark(since, "seq sent")
+        return bool(held)
+
+
+    def invalidate(self):
+        '''
+        Forget what the Launchpad is showing - every slot will be sent on its next flush.
+        That includes the display buffer: a dropped buffer select leaves the driver drawing into the buffer on show,
+        so the next flush selects the buffers again before it draws.
+        '''
+        self.shadow[:] = bytes( [self.UNKNOWN] * len(self.shadow) )
+        self.driver.displayed = None
+
+
+    def resync(self):
+        '''Invalidate the shadow and schedule a flush of the full frame'''
+        with self.parent.framelock:
+            self.invalidate()
+            self.dirty.update( range(len(self.slots)) )
+        self.parent.scheduler.request()
+
+
+    def compile_output(self):
+        '''Pre-encodes the LED messages flush sends, so it never builds a mido.Message'''
+        self.driver.compile()
 
     # utility functions
 
@@ -470,100 +1215,862 @@ class Pad(dict):
         '''
         self.all_leds_off()
 
-        self.outport.send(mido.Message("note_on", channel=0, note=0, velocity=0b000011))
-        self.outport.send(mido.Message("note_on", channel=0, note=1, velocity=0b000010))
-        self.outport.send(mido.Message("note_on", channel=0, note=2, velocity=0b000001))
-        self.outport.send(mido.Message("note_on", channel=0, note=3, veloci0y=0b000000))
+        self.set_ledaddr(0, 0b000011)
+        self.set_ledaddr(1, 0b000010)
+        self.set_ledaddr(2, 0b000001)
+        self.set_ledaddr(3, 0b000000)
+
+        self.set_ledaddr(16, 0b010011)
+        self.set_ledaddr(17, 0b010010)
+        self.set_ledaddr(18, 0b010001)
+        self.set_ledaddr(19, 0b010000)
+
+        self.set_ledaddr(32, 0b100011)
+        self.set_ledaddr(33, 0b100010)
+        self.set_ledaddr(34, 0b100001)
+        self.set_ledaddr(35, 0b100000)
+
+        self.set_ledaddr(48, 0b110011)
+        self.set_ledaddr(49, 0b110010)
+        self.set_ledaddr(50, 0b110001)
+        self.set_ledaddr(51, 0b110000)
+
+
+class ClassicDriver(dict):
+    '''
+    Original Launchpad, Launchpad S and Launchpad Mini protocol - XY layout, red/green velocities, one message per LED.
+
+    Pad keeps its frame, its tables and the setup screens in this protocol's terms - colours are its velocities, LED
+    and button addresses its notes and CCs - so this driver sends them as they are, and other drivers translate.
+    '''
+    name = "classic"
+    portregex = re.compile("Launchpad")
+
+    # rapid update always sends all 80 LEDs - 40 messages plus the layout message that resets its cursor.
+    # only worth it when at least this many LEDs need to be sent.
+    rapid_threshold = 42
+
+    # draw each flush into the hidden display buffer and swap buffers once it's complete
+    double_buffer = True
+
+    # output budget - USB MIDI packets per second we send a pad, a conservative guess at what its USB MIDI
+    # endpoint takes without falling behind.  Set with pyBLM's pad_rate / --pad-rate
+    packet_rate = 3000
+
+    def __init__(self, pad):
+        dict.__init__(self)
+        self.__dict__ = self
+        self.pad = pad
+        self.displayed = None # display buffer the Launchpad is showing - None after a reset, until double buffering is set up
+        self.ledbytes = None # pre-encoded LED messages, built by compile
+
+    def send(self, data):
+        self.pad.rawport.send(data)
+
+    # setup
+
+    def reset(self):
+        self.send( bytes( (0xB0, 0, 0) ) )
+        self.displayed = None # reset also resets the display buffers
+
+    def layout(self):
+        self.send( bytes( (0xB0, 0, 1) ) ) # XY layout
+
+    def brightness(self, brightness):
+        self.send( bytes( (0xB0, 30, brightness) ) )
+
+    def leds_off(self):
+        self.reset()
+        #send empty scroll message in case text is scrolling - scrolling continues through the reset above
+        self.send( bytes( (0xF0, 0, 32, 41, 9, 0, 0xF7) ) )
+
+    def leds_on(self, brightness):
+        self.send( bytes( (0xB0, 0, brightness) ) )
+
+    def scroll_text(self, color, text):
+        self.send( bytes( [ 0xF0, 0, 32, 41, 9, color ] + list(text) + [ 0xF7 ] ) )
+
+    def scroll_done(self, data):
+        return len(data) == 3 and data[0] == 0xB0 and data[1] == 0 and data[2] == 3
+
+    # addresses
+
+    def input_address(self, status, address):
+        '''the (status, address) this model sends for the classic button status/address'''
+        return status, address
+
+    def classic_message(self, msg):
+        '''translate a mido message from this model into the classic Launchpad message for the same button'''
+        return msg
+
+    # LED output
+
+    def led(self, status, address, color):
+        '''set one LED right away - status/address/color are classic ones'''
+        self.send( bytes( (status, address, color) ) )
+
+    def compile(self):
+        '''
+        ledbytes[slot][colour] is the note_on/CC message setting that slot to that colour.
+        '''
+        self.ledbytes = [ [ bytes( (status, address, color) ) for color in range(128) ] for status, address in Pad.slots ]
+        self.xylayoutbytes = bytes( (0xB0, 0, 1) )
+
+    def send_frame(self, frame, changes, rapid):
+        '''send the changed slots of frame - all of them with rapid set'''
+        # a reopened pad is reset from another thread, which sets displayed to None - work from our own copy
+        displayed = self.displayed
+        if self.double_buffer and displayed is None:
+            # display buffer 0 and draw into buffer 1, copying 0 into 1 so both start out the same
+            self.select_buffers(0, 1, copy=True)
+            displayed = 0
+
+        if rapid:
+            self.rapid_update(frame)
+        else:
+            send = self.pad.rawport.send
+            ledbytes = self.ledbytes
+            for slot in changes:
+                send( ledbytes[slot][frame[slot]] )
+
+        if self.double_buffer:
+            # show the buffer we just drew, and copy it into the now hidden buffer so the next frame starts from it
+            self.select_buffers(1 - displayed, displayed, copy=True)
+
+    def frame_cost(self, count, rapid):
+        '''USB MIDI packets send_frame sends for count changed slots'''
+        cost = len(Pad.slots) // 2 + 1 if rapid else count
+        return cost + 2 if self.double_buffer else cost
+
+    def rapid_update(self, frame):
+        '''
+        Sends a whole frame using rapid LED update - note_on on channel 3 sets two LEDs per message, in slot order.
+        '''
+        send = self.pad.rawport.send
+        send( self.xylayoutbytes ) # XY layout resets the rapid update cursor to the first slot
+        for slot in range(0, len(frame), 2):
+            send( bytes( (0x92, frame[slot], frame[slot+1]) ) )
+
+    def select_buffers(self, display, update, copy=False):
+        '''
+        Selects the display buffer the Launchpad shows and the buffer LED messages are written to.
+        With copy set, the LED states of the new display buffer are copied into the new update buffer.
+        CC 0 values 0x20-0x3D: 0x20 + display buffer (bit 0) + update buffer (bit 2) + flash (bit 3) + copy (bit 4)
+        '''
+        value = 0x20 | display | (update << 2) | (0x10 if copy else 0)
+        self.send( bytes( (0xB0, 0, value) ) )
+        self.displayed = display
+
+
+def palette_index(color):
+    '''the nearest RGB Launchpad palette colour to a classic red/green velocity'''
+    red = color & 0x03
+    green = (color >> 4) & 0x03
+    level = max(red, green)
+    if level == 0:
+        return 0
+    if green == 0:
+        base = 5 # red
+    elif red == 0:
+        base = 21 # green
+    elif red >= green:
+        base = 9 # amber
+    else:
+        base = 13 # yellow
+    return base + 3 - level # each palette colour is followed by a dim and a very dim version
+
+
+class RGBDriver(ClassicDriver):
+    '''
+    Launchpad MK2 / Mini MK3 / X family - RGB LEDs set from a colour palette, and a SysEx message that sets any number
+    of LEDs at once, so each flush is a single message however much of the pad changed.
+    The grid is notes 11-88, bottom row first.  Classic colours and addresses are translated on the way out,
+    button addresses on the way back in.
+    '''
+    rapid_threshold = 80 # a flush is one message either way - only send every slot when they've all changed
+    double_buffer = False # a SysEx frame is drawn at once
+
+    palette = tuple( map(palette_index, range(128)) ) # classic velocity -> palette index
+
+    # set by the models
+    sysex = b""         # F0 and the SysEx header, up to the command byte
+    led_command = 0     # SysEx command setting a list of LEDs
+    led_spec = b""      # bytes before each LED's index and colour in that list
+    top_cc = 0          # CC of the leftmost round button on top
+    right_status = 0    # status byte of the round buttons on the right
+
+    def __init__(self, pad):
+        ClassicDriver.__init__(self, pad)
+        self.addresses = [ self.device_address(status, address) for status, address in Pad.slots ] # slot -> (status, address)
+        self.todevice = dict( zip(Pad.slots, self.addresses) )
+        self.toclassic = dict( zip(self.addresses, Pad.slots) )
+        self.ledindex = bytes( address for status, address in self.addresses ) # slot -> LED index in the SysEx
+
+    def device_address(self, status, address):
+        '''the (status, address) of the classic LED/button status/address on this model'''
+        if status == 0xB0:
+            return ( 0xB0, self.top_cc + address - 104 )
+        row, col = address >> 4, address & 0x0F
+        if col == 8:
+            return ( self.right_status, (8 - row) * 10 + 9 )
+        return ( 0x90, (8 - row) * 10 + col + 1 )
+
+    def command(self, command, data=()):
+        self.send( self.sysex + bytes( (command,) ) + bytes(data) + b"\xF7" )
+
+    def reset(self):
+        self.layout()
+
+    def brightness(self, brightness):
+        pass # the RGB models keep their own brightness setting
+
+    def leds_off(self):
+        self.scroll_text(0, [])
+        self.send_frame( bytes(len(Pad.slots)), (), True )
+
+    def leds_on(self, brightness):
+        self.send_frame( bytes( [Pad.ORANGE] * len(Pad.slots) ), (), True )
+
+    def scroll_done(self, data):
+        return False
+
+    def input_address(self, status, address):
+        return self.todevice[ (status, address) ]
+
+    def classic_message(self, msg):
+        if msg.type not in ("note_on", "note_off", "control_change"):
+            return msg
+        data = msg.bytes()
+        status = data[0] & 0xF0
+        value = data[2] if status != 0x80 else 0
+        classic = self.toclassic.get( (0x90 if status == 0x80 else status, data[1]) )
+        if classic is None:
+            return msg
+        return mido.Message.from_bytes( (classic[0], classic[1], value) )
+
+    def led(self, status, address, color):
+        status, address = self.todevice[ (status, address) ]
+        self.send( bytes( (status, address, self.palette[color]) ) )
+
+    def compile(self):
+        pass # the SysEx frame is built straight from the frame and the tables made in __init__
+
+    def send_frame(self, frame, changes, rapid):
+        '''one SysEx setting every changed LED - every LED with rapid set'''
+        palette, ledindex, spec = self.palette, self.ledindex, self.led_spec
+        data = bytearray(self.sysex)
+        data.append(self.led_command)
+        for slot in ( range(len(frame)) if rapid else changes ):
+            data += spec
+            data.append( ledindex[slot] )
+            data.append( palette[frame[slot]] )
+        data.append(0xF7)
+        self.send( bytes(data) )
+
+    def frame_cost(self, count, rapid):
+        size = len(self.sysex) + 2 + ( len(self.led_spec) + 2 ) * ( len(Pad.slots) if rapid else count )
+        return (size + 2) // 3 # three SysEx bytes per packet
+
+
+class LaunchpadMK2Driver(RGBDriver):
+    '''Launchpad MK2 in session layout - round buttons on the right are notes, the ones on top CCs 104-111'''
+    name = "mk2"
+    portregex = re.compile("Launchpad MK2")
+    sysex = bytes( (0xF0, 0x00, 0x20, 0x29, 0x02, 0x18) )
+    led_command = 0x0A
+    top_cc = 104
+    right_status = 0x90
+
+    def layout(self):
+        self.command(0x22, (0,)) # session layout
+
+    def leds_off(self):
+        self.scroll_text(0, [])
+        self.command(0x0E, (0,)) # set all LEDs to palette colour 0
+
+    def scroll_text(self, color, text):
+        # the classic speed bytes 1-7 in the text work on the MK2 too
+        self.command(0x14, [ self.palette[color], 0 ] + list(text) )
+
+    def scroll_done(self, data):
+        return len(data) == 8 and bytes(data[1:7]) == self.sysex[1:] + b"\x15"
+
+
+class LaunchpadMiniMK3Driver(RGBDriver):
+    '''Launchpad Mini MK3 in programmer mode - the round buttons are CCs, 89-19 on the right and 91-98 on top'''
+    name = "minimk3"
+    portregex = re.compile("Launchpad Mini MK3|LPMiniMK3")
+    sysex = bytes( (0xF0, 0x00, 0x20, 0x29, 0x02, 0x0D) )
+    led_command = 0x03
+    led_spec = b"\x00" # static colour
+    top_cc = 91
+    right_status = 0xB0
+
+    def layout(self):
+        self.command(0x0E, (1,)) # programmer mode
+
+    def scroll_text(self, color, text):
+        # there are no inline speed bytes - take the classic ones out and use the first as the speed
+        speeds = [ c for c in text if c < 8 ]
+        text = [ c for c in text if c >= 8 ]
+        if not text:
+            self.command(0x07) # stops the scrolling text
+            return
+        self.command(0x07, [ 0, speeds[0] * 4 if speeds else 10, 0, self.palette[color] ] + text )
+
+
+class LaunchpadXDriver(LaunchpadMiniMK3Driver):
+    '''Launchpad X in programmer mode - same layout and SysEx as the Mini MK3'''
+    name = "x"
+    portregex = re.compile("Launchpad X|LPX")
+    sysex = bytes( (0xF0, 0x00, 0x20, 0x29, 0x02, 0x0C) )
+
 
-        self.outport.send(mido.Message("note_on", channel=0, note=16, velocity=0b010011))
-        self.outport.send(mido.Message("note_on", channel=0, note=17, velocity=0b010010))
-        self.outport.send(mido.Message("note_on", channel=0, note=18, velocity=0b010001))
-        self.outport.send(mido.Message("note_on", channel=0, note=19, velocity=0b010000))
+# most specific first - plain "Launchpad" matches everything else
+drivers = [ LaunchpadMK2Driver, LaunchpadMiniMK3Driver, LaunchpadXDriver, ClassicDriver ]
 
-        self.outport.send(mido.Message("note_on", channel=0, note=32, velocity=0b100011))
-        self.outport.send(mido.Message("note_on", channel=0, note=33, velocity=0b100010))
-        self.outport.send(mido.Message("note_on", channel=0, note=34, velocity=0b100001))
-        self.outport.send(mido.Message("note_on", channel=0, note=35, velocity=0b100000))
+# the MK3 models also have a DAW port - it isn't for us
+dawregex = re.compile(r"\bDAW?\b")
 
-        self.outport.send(mido.Message("note_on", channel=0, note=48, velocity=0b110011))
-        self.outport.send(mido.Message("note_on", channel=0, note=49, velocity=0b110010))
-        self.outport.send(mido.Message("note_on", channel=0, note=50, velocity=0b110001))
-        self.outport.send(mido.Message("note_on", channel=0, note=51, velocity=0b110000))
 
+def find_driver(portname):
+    '''the driver class for a Launchpad MIDI port name, None if it isn't a Launchpad port we can use'''
+    if dawregex.search(portname):
+        return None
+    for driver in drivers:
+        if driver.portregex.search(portname):
+            return driver
+    return None
 
-class Led(dict):
 
-    def __init__(self, parent_blm, row, col, padnum, address, statusbyte=0x90, redstate=0, greenstate=0):
+class LedMap(dict):
+    '''
+    Flat table framebuffer for one of the BLM's LED maps - the main grid, the extra rows or the extra columns.
+    Every table is indexed row * numcols + col, so a row is a contiguous slice and a column a slice with step numcols.
+    The red and green planes hold the logical LED state, the pad/status/address tables hold the precomputed
+    Launchpad destination of each LED.  pad == -1 means there is no LED at that position in the current layout.
+    Single LED updates are interactive feedback, and so is everything on an interactive map - the pads send them first.
+    '''
+
+    RED_PLANE = 0
+    GREEN_PLANE = 1
+
+    # pattern byte -> its 8 bits, LSB first
+    bits = tuple( bytes( (value >> i) & 1 for i in range(8) ) for value in range(256) )
+
+    # Launchpad colour, indexed by (greenstate << 1) | redstate
+    colors = ( Pad.OFF, Pad.RED, Pad.GREEN, Pad.ORANGE )
+
+    def __init__(self, parent_blm, numrows, numcols, interactive=False):
         dict.__init__(self)
         self.__dict__ = self
 
         self.parent = parent_blm
-        self.row=row
-        self.col=col
-        self.padnum=padnum
-        self.ledaddress=address
-        self.statusbyte=statusbyte
-        self.redstate=redstate
-        self.greenstate=greenstate
-
-    def get_color(self):
-        if (self.redstate == 1 and self.greenstate == 1):
-            color = Pad.ORANGE
-        elif (self.redstate == 1):
-            color = Pad.RED
-        elif (self.greenstate == 1):
-            color = Pad.GREEN
+        self.interactive = interactive
+        self.numrows = numrows
+        self.numcols = numcols
+        size = numrows * numcols
+        self.red = bytearray(size)
+        self.green = bytearray(size)
+        self.planes = ( self.red, self.green ) # indexed by RED_PLANE/GREEN_PLANE
+
+        self.pad = [-1] * size
+        self.status = bytearray(size)
+        self.address = bytearray(size)
+        self.slot = bytearray(size) # Pad.slots index of each LED
+
+    def set_led(self, row, col, padnum, address, statusbyte=0x90):
+        '''store the Launchpad destination of the LED at row/col'''
+        i = row * self.numcols + col
+        self.pad[i] = padnum
+        self.address[i] = address
+        self.status[i] = statusbyte
+        self.slot[i] = Pad.slotmap[ (statusbyte, address) ]
+
+    def update_both(self, row, col, redstate, greenstate):
+        '''single LED update'''
+        i = row * self.numcols + col
+        if redstate != self.red[i] or greenstate != self.green[i]:
+            self.red[i] = redstate
+            self.green[i] = greenstate
+            self.redraw( (i,), True )
+
+    def update_row(self, row, half, plane, bits):
+        '''apply an 8 LED pattern to the left (half=0) or right (half=1) half of a row of one colour plane'''
+        start = row * self.numcols + half * 8
+        target = self.planes[plane]
+        old = target[start:start+8]
+        if old != bits:
+            target[start:start+8] = bits
+            self.redraw( [ start + i for i in range(8) if old[i] != bits[i] ] )
+
+    def update_col(self, col, half, plane, bits):
+        '''apply an 8 LED pattern to the top (half=0) or bottom (half=1) half of a column of one colour plane'''
+        stride = self.numcols
+        start = half * 8 * stride + col
+        stop = start + 8 * stride
+        target = self.planes[plane]
+        old = target[start:stop:stride]
+        if old != bits:
+            target[start:stop:stride] = bits
+            self.redraw( [ start + i * stride for i in range(8) if old[i] != bits[i] ] )
+
+    def redraw(self, indices, urgent=False):
+        '''copy the current colour of the LEDs at the given flat indices into their pads' frames - sent on the next flush'''
+        red, green, colors, pad, slot = self.red, self.green, self.colors, self.pad, self.slot
+        pads = self.parent.pad
+        urgent = urgent or self.interactive
+        for i in indices:
+            padnum = pad[i]
+            if padnum >= 0:
+                pads[padnum].set_led( slot[i], colors[ red[i] | (green[i] << 1) ], urgent )
+
+
+class FlushScheduler(threading.Thread):
+    '''
+    Coalesces LED output.  The SEQ callback only draws into the pads' frames and calls request().
+    This thread flushes the latest state of every pad at most max_rate times per second, so LED states
+    superseded between two flushes are never sent.
+    '''
+
+    def __init__(self, parent_blm, max_rate=100):
+        threading.Thread.__init__(self, name="FlushScheduler", daemon=True)
+        self.parent = parent_blm
+        self.interval = 1.0 / max_rate
+        self.pending = threading.Event()
+        self.running = True
+
+    def request(self):
+        '''ask for a flush - returns immediately, the flush happens on the scheduler thread'''
+        self.pending.set()
+
+    def stop(self):
+        self.running = False
+        self.pending.set()
+
+    def run(self):
+        next_flush = time.monotonic()
+        while self.running:
+            self.pending.wait()
+
+            # rate cap - anything drawn while we wait is picked up by this flush
+            delay = next_flush - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+            self.pending.clear()
+            try:
+                self.parent.flush()
+            except Exception:
+                # one bad flush mustn't stop the LEDs of every pad for good
+                log.exception("LED flush failed")
+                trace.dump()
+            next_flush = time.monotonic() + self.interval
+
+
+class Subscriber(dict):
+    '''one remote viewer of a FramePublisher - a TCP connection, or a UDP address'''
+
+    def __init__(self, interval, sock=None, address=None):
+        dict.__init__(self)
+        self.__dict__ = self
+        self.sock = sock # TCP connection, None for UDP
+        self.address = address
+        self.interval = interval # seconds between frames
+        self.next_send = 0.0 # monotonic time the next frame is due
+        self.next_keyframe = 0.0
+        self.seq = 0 # sequence number of the last message sent
+        self.base = None # packed frame the next delta applies to, and its sequence number
+        self.base_seq = 0
+        self.last = None # packed frame last sent
+        self.inbuf = b"" # TCP - partial request line
+        self.outbuf = b"" # TCP - what the socket didn't take yet.  No frames are made for the viewer until it's gone
+        self.expires = None # UDP - monotonic time the subscription runs out
+
+
+class FramePublisher(threading.Thread):
+    '''
+    Streams the BLM's LED state to remote viewers over TCP and UDP, from its own thread.  It only ever copies the
+    LedMaps' red and green planes, so it never holds up decoding or the flushes to the Launchpads.
+
+    A frame is packed as bitplanes, one bit per LED, LSB first: the main grid's red and green planes (16x16),
+    then the extra rows' (2x16), then the extra columns' (2x16) - 80 bytes.  Every message is the header
+    (magic, version, kind, sequence number, sequence number of the frame a delta applies to) and a payload:
+      keyframe - numrows, numcols, numxrows, numxcols, then the packed frame
+      delta    - the XOR of the packed frame with an earlier one, as (zero bytes to skip, count, count bytes) runs
+    Keyframes go out every keyframe_interval seconds, and whenever a delta wouldn't be smaller.  Frames that
+    haven't changed aren't sent.
+
+    TCP: connect, and optionally send "rate <Hz>\n".  Messages are prefixed with their uint16 length, and each
+    delta applies to the message before it.  A viewer too slow to take everything just gets fewer frames.
+    UDP: send a "subscribe [<Hz>]" datagram, and repeat it within subscription_timeout seconds to keep receiving -
+    "unsubscribe" ends it.  One message per datagram, and deltas apply to the last keyframe, so a lost datagram
+    only loses that frame.
+    '''
+    MAGIC = b"pBLM"
+    VERSION = 1
+    KEYFRAME = 0
+    DELTA = 1
+    header = struct.Struct("<4sBBII")
+    length = struct.Struct("<H")
+
+    keyframe_interval = 2.0
+    subscription_timeout = 10.0
+
+    # 8 plane bytes -> the packed byte, the inverse of LedMap.bits
+    packbits = { bits: value for value, bits in enumerate(LedMap.bits) }
+
+    def __init__(self, parent_blm, address, max_rate=30):
+        threading.Thread.__init__(self, name="FramePublisher", daemon=True)
+        self.parent = parent_blm
+        self.address = address
+        self.max_rate = max_rate
+        self.interval = 1.0 / max_rate
+        self.subscribers = {} # TCP socket or UDP address -> Subscriber
+        self.running = True
+
+        # bind now, so a port that's in use is reported before the setup starts
+        family = socket.AF_INET6 if ":" in address[0] else socket.AF_INET
+        self.server = socket.create_server(address, family=family)
+        self.server.setblocking(False)
+        self.udp = socket.socket(family, socket.SOCK_DGRAM)
+        self.udp.bind(address)
+        self.udp.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.server, selectors.EVENT_READ)
+        self.selector.register(self.udp, selectors.EVENT_READ)
+        log.info("Publishing the BLM frame on TCP and UDP %s port %i" % address)
+
+    def stop(self):
+        '''end the thread and close the sockets - takes up to half a second'''
+        self.running = False
+        if self.ident is not None:
+            self.join() # run closes them on its way out
         else:
-            color = Pad.OFF
-
-        return color
-
-    def redraw(self):
-        newcolor=self.get_color();
-        if self.statusbyte == 0x90:
-            self.parent.pad[self.padnum].set_ledaddr(self.ledaddress, newcolor)
-        elif self.statusbyte == 0xB0 :
-            self.parent.pad[self.padnum].set_CC_ledaddr(self.ledaddress, newcolor)
-
-
-    def update_red(self, redstate):
-        if redstate != self.redstate:
-            self.redstate = redstate
-            self.redraw()
-
-    def update_green(self, greenstate):
-        if greenstate != self.greenstate:
-            self.greenstate = greenstate
-            self.redraw()
-
-    def update_both(self, redstate, greenstate):
-        if redstate != self.redstate or greenstate != self.greenstate:
-            self.redstate = redstate
-            self.greenstate = greenstate
-            self.redraw()
-
-    def update_one(self, color, colorstate) :
-        #log.debug("Led.update_one: %s = %s" % (color, colorstate))
-        if color == "green" :
-            if self.greenstate != colorstate :
-                self.greenstate = colorstate
-                self.redraw()
+            self.close() # never started
+
+    def close(self):
+        for sub in list(self.subscribers.values()):
+            if sub.sock is not None:
+                sub.sock.close()
+        self.subscribers = {}
+        self.selector.close()
+        self.server.close()
+        self.udp.close()
+
+    # frames
+
+    def snapshot(self):
+        '''the current frame, packed.  bytes() copies each plane in one go, so no lock is needed'''
+        blm = self.parent
+        planes = b"".join( bytes(plane) for ledmap in (blm.ledmap, blm.xrowmap, blm.xcolmap) for plane in ledmap.planes )
+        packbits = self.packbits
+        return bytes( packbits[ planes[i:i+8] ] for i in range(0, len(planes), 8) )
+
+    @staticmethod
+    def delta(old, new):
+        '''run length coded XOR of two packed frames'''
+        diff = ( int.from_bytes(old, "little") ^ int.from_bytes(new, "little") ).to_bytes(len(new), "little")
+        out = bytearray()
+        i, n = 0, len(diff)
+        while i < n:
+            start = i
+            while i < n and diff[i] == 0 and i - start < 255:
+                i += 1
+            if i == n:
+                break
+            skip = i - start
+            start = i
+            while i < n and diff[i] != 0 and i - start < 255:
+                i += 1
+            out.append(skip)
+            out.append(i - start)
+            out += diff[start:i]
+        return bytes(out)
+
+    def send_frame(self, sub, frame, now):
+        '''send sub a keyframe or a delta of frame, whichever is due'''
+        sub.next_send = now + sub.interval
+        kind = self.KEYFRAME
+        if sub.base is not None and now < sub.next_keyframe:
+            if frame == sub.last:
+                return
+            payload = self.delta(sub.base, frame)
+            if len(payload) < len(frame):
+                kind = self.DELTA
+        if kind == self.KEYFRAME:
+            blm = self.parent
+            payload = bytes( (blm.numrows, blm.numcols, blm.numxrows, blm.numxcols) ) + frame
+            sub.next_keyframe = now + self.keyframe_interval
+
+        sub.seq = (sub.seq + 1) & 0xFFFFFFFF
+        msg = self.header.pack(self.MAGIC, self.VERSION, kind, sub.seq, sub.seq if kind == self.KEYFRAME else sub.base_seq) + payload
+        if kind == self.KEYFRAME or sub.sock is not None:
+            sub.base = frame # over UDP, deltas stay on the last keyframe
+            sub.base_seq = sub.seq
+        sub.last = frame
+
+        if sub.sock is None:
+            try:
+                self.udp.sendto(msg, sub.address)
+            except OSError:
+                pass # full socket buffer or gone - the next keyframe catches up
         else:
-            if self.redstate != colorstate :
-                self.redstate = colorstate
-                self.redraw()
+            self.tcp_send(sub, self.length.pack(len(msg)) + msg)
+
+    # connections
+
+    def tcp_send(self, sub, data):
+        try:
+            sent = sub.sock.send(data)
+        except BlockingIOError:
+            sent = 0
+        except OSError:
+            self.drop(sub)
+            return
+        sub.outbuf = data[sent:]
+        self.selector.modify(sub.sock, selectors.EVENT_READ | selectors.EVENT_WRITE if sub.outbuf else selectors.EVENT_READ)
+
+    def drop(self, sub):
+        log.info("Viewer %s unsubscribed" % (sub.address,))
+        del self.subscribers[sub.sock]
+        self.selector.unregister(sub.sock)
+        sub.sock.close()
+
+    def rate_interval(self, words):
+        '''the frame interval a "rate <Hz>" / "subscribe <Hz>" request asks for - never faster than our max rate'''
+        try:
+            return max( 1.0 / float(words[1]), self.interval ) if len(words) > 1 else self.interval
+        except (ValueError, ZeroDivisionError):
+            return self.interval
+
+    def accept(self):
+        try:
+            sock, address = self.server.accept()
+        except OSError:
+            return
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.subscribers[sock] = Subscriber(self.interval, sock, address)
+        self.selector.register(sock, selectors.EVENT_READ)
+        log.info("Viewer %s subscribed over TCP" % (address,))
+
+    def tcp_read(self, sub):
+        try:
+            data = sub.sock.recv(1024)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+        if not data:
+            self.drop(sub)
+            return
+        lines = (sub.inbuf + data).split(b"\n")
+        sub.inbuf = lines.pop()[-256:]
+        for line in lines:
+            words = line.split()
+            if words and words[0] == b"rate":
+                sub.interval = self.rate_interval(words)
+                sub.next_send = 0.0
+
+    def udp_read(self, now):
+        try:
+            data, address = self.udp.recvfrom(256)
+        except OSError:
+            return
+        words = data.split()
+        if not words:
+            return
+        sub = self.subscribers.get(address)
+        if words[0] == b"subscribe":
+            if sub is None:
+                sub = self.subscribers[address] = Subscriber(self.interval, address=address)
+                log.info("Viewer %s subscribed over UDP" % (address,))
+            sub.interval = self.rate_interval(words)
+            sub.expires = now + self.subscription_timeout
+        elif words[0] == b"unsubscribe" and sub is not None:
+            del self.subscribers[address]
+            log.info("Viewer %s unsubscribed" % (address,))
+
+    def run(self):
+        while self.running:
+            now = time.monotonic()
+            timeout = 0.5 # also how long stop() can take
+            for sub in self.subscribers.values():
+                if not sub.outbuf:
+                    timeout = min( timeout, max(sub.next_send - now, 0) )
+
+            for key, events in self.selector.select(timeout):
+                if key.fileobj is self.server:
+                    self.accept()
+                elif key.fileobj is self.udp:
+                    self.udp_read(time.monotonic())
+                else:
+                    sub = self.subscribers.get(key.fileobj)
+                    if sub is not None and events & selectors.EVENT_READ:
+                        self.tcp_read(sub)
+                    if sub is not None and sub.sock in self.subscribers and events & selectors.EVENT_WRITE:
+                        self.tcp_send(sub, sub.outbuf)
+
+            now = time.monotonic()
+            frame = None
+            for key, sub in list(self.subscribers.items()):
+                if sub.expires is not None and now > sub.expires:
+                    del self.subscribers[key]
+                    log.info("Viewer %s subscription expired" % (key,))
+                elif now >= sub.next_send and not sub.outbuf:
+                    if frame is None:
+                        frame = self.snapshot()
+                    self.send_frame(sub, frame, now)
+
+        self.close()
+
+
+class LinkMonitor(dict):
+    '''
+    Watches the links to the SEQ and the pads - checked from the main loop, or the asyncio BLM's monitor task.
+
+    The SEQ is pinged every ping_interval seconds, and the round trip timed on the monotonic clock.  It's down once
+    it has sent nothing for timeout seconds - it answers every ping, so that's a reboot or a USB hiccup.  The port
+    names are listed every port_interval seconds: a device whose ports have gone is closed, and reopened when they
+    come back under the same name (the ALSA client number may change).
+    When the SEQ or a pad comes back, the layout is pushed to the SEQ again and every pad repainted from its frame -
+    the stored LED state - in one flush.
+    '''
 
+    interval = 0.05 # between checks
+    ping_interval = 0.2
+    timeout = 0.5
+    port_interval = 0.3
+    layout_interval = 1.0 # layout is sent this often while the SEQ is silent
+
+    def __init__(self, parent_blm):
+        dict.__init__(self)
+        self.__dict__ = self
+        self.parent = parent_blm
+        self.seq_up = True
+        self.next_ping = 0.0
+        self.next_ports = 0.0
+        self.next_layout = 0.0
+        self.port_clients = None # rtmidi MidiIn and MidiOut kept for listing the ports
+
+    def start(self):
+        '''the setup has kept the SEQ waiting - give it timeout seconds to answer the first ping'''
+        self.parent.seq.last_message = time.monotonic()
+
+    def check(self):
+        recovered = self.poll_ports() if self.ports_due() else False
+        self.check_link(recovered)
+
+    def check_link(self, recovered=False):
+        '''
+        ping the SEQ and time it out - recovered is True if poll_ports has just reopened a device.
+        The asyncio BLM polls the ports off the loop, and calls this on it.
+        '''
+        now = time.monotonic()
+        seq = self.parent.seq
+
+        if seq.inport is not None:
+            silent = now - seq.last_message
+            if self.seq_up and silent > self.timeout:
+                self.seq_up = False
+                log.error("SEQ silent for %.0f ms - link down" % (silent * 1e3))
+            elif not self.seq_up and silent <= self.timeout:
+                self.seq_up = True
+                recovered = True
+                log.error("SEQ link up again")
+
+            if not self.seq_up and now >= self.next_layout:
+                self.next_layout = now + self.layout_interval
+                seq.send_layout()
+            if now >= self.next_ping:
+                self.next_ping = now + self.ping_interval
+                seq.send_ping()
+                log.debug("SEQ ping rtt: %s" % ( "%.2f ms" % (seq.rtt * 1e3) if seq.rtt is not None else "-" ))
+
+        if recovered:
+            self.resync()
+
+    def ports_due(self):
+        return time.monotonic() >= self.next_ports
+
+    def poll_ports(self):
+        '''list the ports, and close or reopen the devices whose ports have gone or come back.  True if any were reopened'''
+        names = self.list_ports()
+        return names is not None and self.check_ports(names)
+
+    def list_ports(self):
+        '''
+        the set of names of the MIDI ports that are both inputs and outputs, or None if they can't be listed.
+        With rtmidi, one MidiIn and one MidiOut are kept for this - mido would open a new pair of sequencer clients
+        every time, and the ports are listed every port_interval seconds.
+        '''
+        self.next_ports = time.monotonic() + self.port_interval
+        try:
+            if mido.backend.name == "mido.backends.rtmidi":
+                if self.port_clients is None:
+                    import rtmidi
+                    api = getattr(rtmidi, "API_" + mido.backend.api) if mido.backend.api else rtmidi.API_UNSPECIFIED
+                    self.port_clients = ( rtmidi.MidiIn(rtapi=api), rtmidi.MidiOut(rtapi=api) )
+                midiin, midiout = self.port_clients
+                return set( midiin.get_ports() ) & set( midiout.get_ports() )
+            return set( mido.get_ioport_names() )
+        except Exception as e:
+            log.error("Couldn't list MIDI ports - %s" % e)
+            return None
+
+    def close(self):
+        '''release the rtmidi clients list_ports keeps - they're opened again if it's called after this'''
+        if self.port_clients is not None:
+            for client in self.port_clients:
+                client.delete()
+            self.port_clients = None
+
+    def check_ports(self, names):
+        '''close the devices whose ports have gone, reopen the ones that are back.  Returns True if any were reopened'''
+        blm = self.parent
+        devices = [ blm.seq ] + blm.pad
+        reopened = False
+        for device in devices:
+            if device.inport is not None and device.name not in names:
+                log.error("%s has gone" % device.name)
+                device.close_ports()
+                if device is blm.seq:
+                    self.seq_up = False
+
+        for device in devices:
+            if device.inport is None:
+                taken = set( other.name for other in devices if other.inport is not None )
+                name = find_port(device.name, names - taken)
+                if name is not None:
+                    try:
+                        device.reopen(name)
+                    except Exception as e:
+                        log.error("Couldn't reopen %s - %s" % (name, e))
+                        close_ports(device)
+                        continue
+                    log.error("%s is back" % name)
+                    if device is blm.seq:
+                        self.next_layout = 0.0 # resynced once it answers
+                    else:
+                        reopened = True
+        return reopened
 
-class Button():
+    def resync(self):
+        '''push the layout, and repaint every pad from its frame in one flush'''
+        blm = self.parent
+        if blm.seq.inport is not None:
+            blm.seq.send_layout()
+        with blm.framelock:
+            for pad in blm.pad:
+                pad.invalidate()
+                pad.dirty.update( range(len(pad.slots)) )
+        blm.scheduler.request()
+        log.error("Layout sent, all pads repainted")
 
-    def __init__(self, row, col):
-        self.row=row
-        self.col=col
 
-        # row or col >= 100 means extra row or col.  col 100 = first x column, and 101 = second
-        # row 100 = the only x row
-        # extra rows and column buttons that are CCs have 200 added to their ledaddress, so that non-unique numbers are not overwritten by Led Matrix button map process
-        # coordinates are relative to the whole BLM, with rotation, etc. - not to the individual pad
+class SetupError(Exception):
+    '''the BLM can't be set up with the MIDI devices that are connected'''
 
 
 class pyBLM:
@@ -573,16 +2080,34 @@ class pyBLM:
     With some tweaks to improve usability
     '''
 
-    def __init__(self):
+    # the SEQ's four USB ports - group 1 is the port number
+    SEQ_REGEX = "MIDIbox SEQ V4:MIDIbox SEQ V4 MIDI ([1-4]) [0-9]"
+
+    seq_overflow = "block" # the SEQ's writer never drops - see Seq.start_writer
+
+    def __init__(self, max_flush_rate=100, run=True, writer_queue_size=1024, writer_overflow="drop_oldest", layout_cache="~/.pyBLM_layout.json",
+                 seq_regex=None, pad_regex=None, pad_rate=None, publish=None, publish_rate=30):
         log.info("pyBLM init")
 
         self.pad = [] # zero based list of active pads in the BLM config
         self.seq = False # will store Seq object once the SEQ BLM port is found or configured
         self.seq_BLM_portnum = 0 # store integer - number of MBseq USB port assigned to BLM
         self.seq_portnames = {} # 1, 2, 3, 4 indexed list of the full names of the 4 BLM USB ports found.
-        self.ledmap= [] # zero based 2d matrix mapping row/column to a Led object -- map[row][col]=Led object
-        self.xrowmap = [] # zero based - may contain up to two extra row maps -- maps[row] = Led object
-        self.xcolmap = [] # zero based - may contain up to two extra col maps -- maps[col] = Led object
+        self.ledmap = None # LedMap framebuffer for the main grid -- indexed [row, col]
+        self.xrowmap = None # LedMap framebuffer for up to two extra rows -- indexed [xrow, col]
+        self.xcolmap = None # LedMap framebuffer for up to two extra columns -- indexed [xcol, row]
+        self.cctable = [None] * 128 # SEQ pattern transfer decoder, built by grid_config - see build_cctable
+        self.pending_since = None # perf_counter time of the oldest SEQ message waiting to be flushed - only tracked with stats enabled
+        self.framelock = threading.Lock() # held while the LedMaps and pad frames are written, or a pad's frame is snapshotted for flushing
+        self.scheduler = FlushScheduler(self, max_flush_rate) # flushes LED output at up to max_flush_rate Hz
+        self.monitor = LinkMonitor(self) # pings the SEQ, and resyncs after a device has gone and come back
+        self.writer_queue_size = writer_queue_size # per output port writer thread queue size - see PortWriter
+        self.writer_overflow = writer_overflow # overflow policy of the pads' writers - the SEQ's is seq_overflow
+        self.publisher = FramePublisher(self, publish, publish_rate) if publish else None # streams the LED state to remote viewers - publish is its (host, port)
+        self.pad_rate = pad_rate # output budget of each pad in USB MIDI packets per second - None for the driver's default, 0 for no limit
+        self.layout_cache = os.path.expanduser(layout_cache) if layout_cache else None # file the pad order and SEQ port are saved in - None to always run the interactive setup
+        self.seqregex = re.compile(seq_regex or self.SEQ_REGEX) # which SEQ's ports this BLM binds to
+        self.padregex = re.compile(pad_regex) if pad_regex else None # which Launchpads it may use - None for all of them
 
         # layout info
         self.numrows=0
@@ -592,23 +2117,34 @@ class pyBLM:
         self.numxcols=2
         self.numxbuttons=0
 
-        # initial configuration
-        self.connect()
-        self.grid_config()
-        self.set_callbacks()
-        self.print_connections()
-
-        # Main Loop - this just takes care of checking for a >5 second lapse without SEQ communication, and causes LAYOUT to be sent if needed
-        # All the real BLM action is in the SEQ and the pad port callback functions
-        while True:
-            elapsed = time.time() - self.seq.last_message
-            log.debug ("MAINLOOP - TIME: %s" % (elapsed))
-            if elapsed > 4.5:
-                self.seq.send_layout()
+        if run:
+            # initial configuration - skip the interactive setup if we've seen this set of MIDI ports before
+            if self.restore_layout():
+                startup.mark("restore cached layout")
             else:
-                self.seq.send_ping()
-
-            time.sleep(4)
+                self.connect()
+                self.save_layout()
+                startup.mark("interactive setup")
+            self.grid_config()
+            startup.mark("grid config")
+            self.set_callbacks()
+            if self.publisher:
+                self.publisher.start()
+            startup.mark("callbacks and resync")
+            self.print_connections()
+            startup.dump()
+
+            self.mainloop()
+
+    def mainloop(self):
+        '''
+        Main Loop - this just takes care of the link monitor.
+        All the real BLM action is in the SEQ and the pad port callback functions
+        '''
+        self.monitor.start()
+        while True:
+            self.monitor.check()
+            time.sleep(self.monitor.interval)
 
     def connect(self):
         '''
@@ -621,154 +2157,294 @@ class pyBLM:
         of the config, sends to a separate function that finishes the internal configuration, then connects to the SEQ and
         starts the BLM.  User can set up less than the connected number of launchpads by pressing 1,2,3 or 4 at any time.
         '''
-
         # find connected launchpads and find the midibox ports
-        input_names = mido.get_input_names()
-        temppad = {} # store pads temporarily during setup. create new pads when user selects them to be active in the BLM, delete both of these temp vars when config's done
-        seqregex = re.compile("MIDIbox SEQ V4:MIDIbox SEQ V4 MIDI ([1-4]) [0-9]")
-
-        for name in input_names:
-            if ( "Launchpad" in name ):
-                temppad[name] = Pad(self, name)
-                continue
-
-            match = seqregex.search(name)
-            if ( match ):
-                self.seq_portnames[int(match.group(1))] = name
-                # log.debug("MatchGrp1: %s - Name: %s" % ( match.group(1), name ))
-                continue
+        padnames = self.find_ports( mido.get_input_names() )
+        # store pads temporarily during setup. pads become active in the BLM when the user selects them, the rest are closed when config's done
+        temppad = dict( zip( padnames, self.open_pads(padnames) ) )
 
         if len(temppad) <= 0 :
-            log.error( 'ERROR: %s' % "Couldn't find any launchpads")
-            sys.exit(1)
+            raise SetupError("Couldn't find any launchpads")
         if len(self.seq_portnames) != 4:
-            log.error('ERROR: %s' % "Couldn't find the seq")
-            sys.exit(1)
+            self.close_pads( temppad.values() )
+            raise SetupError("Couldn't find the seq")
         else:
             log.info ('''%i Launchpads found, %i SEQ Ports found.''' % (len(temppad), len(self.seq_portnames)))
 
+        # every pad's input callback feeds one queue of (name, msg) events
+        # in classic Launchpad terms, whatever the model
+        events = queue.Queue()
+        for name, pad in temppad.items() :
+            pad.inport.callback = lambda msg, name=name, pad=pad: events.put( (name, pad.driver.classic_message(msg)) )
+
         # Set leds to indicate start of interactive config routine
         for x, pad in temppad.items() :
             # draws a line of illuminated buttons based on the number of Launchpads detected
             for i in range(len(temppad)):
                 pad.set_ledxy(2, i+1, Pad.GREEN)
 
-        # log.debug("loop through the pads we found, polling for messages. Waiting for the user to press buttons on each of the launchpads to set their position and to determine size of  the BLM.")
+        # log.debug("Waiting for the user to press buttons on each of the launchpads to set their position and to determine size of  the BLM.")
         while self.seq_BLM_portnum not in (1,2,3,4):
-            for name, pad in temppad.items():
+            name, msg = events.get()
+            pad = temppad[name]
+            logmidi.debug("name: %s - Msg: %s", name, msg) # formatted only if debug logging is on
+
+            if ( msg.type == "note_on" and msg.velocity > 0 ):
+                if msg.note in Pad.midinums["gridnotes"] and not pad.isset:
+                    pad.all_leds_off()
+                    padnum = len(self.pad)
+
+                    # log.debug("Add the pad (%s) to the BLM at self.pad[%s] " % (name, padnum))
+                    pad.set_padnum(padnum)
+                    self.pad.append(pad)
 
-                time.sleep(.1)
-                msg = pad.inport.poll()
+                    # scroll the pad number on the pad we just configured
+                    pad.scroll_text(Pad.GREEN, [ 49+padnum ])
 
-                if ( not msg ):
+                    # set orange LED on BLM port select buttons
+                    for i in range(104, 108, 1):
+                        pad.set_CC_ledaddr(i, Pad.DIM_ORANGE)
+
+                    # set green LED on BLM port autodetect buttons
+                    pad.set_CC_ledaddr(110, Pad.GREEN)
+                    pad.set_CC_ledaddr(111, Pad.GREEN)
+
+            elif ( msg.type == "control_change" and len(self.pad) > 0):
+                if msg.channel == 0 and msg.control == 0 and msg.value == 3 :
+                    # this is the LaunchPad's "hey, I'm done scrolling" message
                     continue
-                else:
-                    logmidi.debug("name: %s - Msg: %s" %(name,msg))
 
-                if ( msg.type == "note_on" and msg.velocity > 0 ):
-                    if msg.note in Pad.midinums["gridnotes"] and not pad.isset:
+                elif ( msg.control in ( 104, 105, 106, 107 ) ):
+                    # User has finished entering the pad layout, and has specified the BLM port
+                    # SPECIFY SEQ BLM PORT - ASSUME DEVICE ID NUMBER hardcoded into Seq.syx_dev_id
+                    self.seq_BLM_portnum = msg.control - 103
+                    self.seq = Seq( self.seq_portnames[ self.seq_BLM_portnum ], self.seq_BLM_portnum, self )
+                    print("configured Seq BLM port %s" % self.seq_BLM_portnum)
+
+                    for pad in self.pad :
                         pad.all_leds_off()
-                        padnum = len(self.pad)
-                        pad.isset = True
+                        pad.scroll_text(Pad.GREEN, [ 7, 48+self.seq_BLM_portnum ])
 
-                        # log.debug("Set up the new pad object (%s) at self.pad[%s] " % (name, padnum))
-                        self.pad.append( Pad(self, name, padnum) )
+                elif ( msg.control in ( 110,111 )):
+                    # AUTODETECT BLM PORT AND SEQ DEVICE ID NUMBER
+                    self.find_BLM_port()
+                    for pad in self.pad :
+                        pad.all_leds_off()
+                        pad.scroll_text(Pad.GREEN, [ 7, 48+self.seq_BLM_portnum ])
 
-                        # scroll the pad number on the pad we just configured
-                        self.pad[padnum].outport.send(mido.Message("sysex", data=[ 0, 32, 41, 9, Pad.GREEN, 49+padnum ] ))
+        # stop listening for setup events - set_callbacks takes over the pads in the BLM.  Close the ones the user didn't pick.
+        for x, pad in temppad.items() :
+            pad.inport.callback = None
+            if not pad.isset:
+                pad.inport.close()
+                pad.outport.close()
+        del temppad
 
-                        # set orange LED on BLM port select buttons
-                        for i in range(104, 108, 1):
-                            self.pad[padnum].outport.send(mido.Message("control_change", channel=0, control=i, value=Pad.DIM_ORANGE))
 
-                        # set green LED on BLM port autodetect buttons
-                        self.pad[padnum].outport.send(mido.Message("control_change", channel=0, control=110, value=Pad.GREEN))
-                        self.pad[padnum].outport.send(mido.Message("control_change", channel=0, control=111, value=Pad.GREEN))
+    def find_ports(self, input_names):
+        '''
+        sorts MIDI port names into launchpads and SEQ ports.  Fills in self.seq_portnames, returns the list of launchpad names.
+        Only the ports matching this BLM's SEQ and pad regexes count - other BLMs may be using the rest.
+        '''
+        padnames = []
 
-                    else:
-                        continue
+        for name in input_names:
+            if self.is_pad_port(name):
+                padnames.append(name)
+                continue
 
-                elif ( msg.type == "control_change" and len(self.pad) > 0):
-                    if msg.channel == 0 and msg.control == 0 and msg.value == 3 :
-                        # this is the LaunchPad's "hey, I'm done scrolling" message
-                        continue
+            match = self.seqregex.search(name)
+            if ( match ):
+                self.seq_portnames[int(match.group(1))] = name
+                # log.debug("MatchGrp1: %s - Name: %s" % ( match.group(1), name ))
+                continue
+
+        return padnames
 
-                    elif ( msg.control in ( 104, 105, 106, 107 ) ):
-                        # User has finished entering the pad layout, and has specified the BLM port
-                        # SPECIFY SEQ BLM PORT - ASSUME DEVICE ID NUMBER hardcoded into Seq.syx_dev_id
-                        self.seq_BLM_portnum = msg.control - 103
-                        self.seq = Seq( self.seq_portnames[ self.seq_BLM_portnum ], self.seq_BLM_portnum, self )
-                        print("configured Seq BLM port %s" % self.seq_BLM_portnum)
 
-                        for pad in self.pad :
-                            pad.all_leds_off()
-                            pad.outport.send( mido.Message("sysex", data=[ 0, 32, 41, 9, Pad.GREEN, 7, 48+self.seq_BLM_portnum ] ) )
+    def is_pad_port(self, name):
+        return find_driver(name) is not None and ( self.padregex is None or self.padregex.search(name) is not None )
 
+    def layout_key(self, input_names):
+        '''
+        layouts are cached per set of MIDI input port names - the Launchpad and SEQ ports this BLM may use.  Their ALSA
+        client numbers are left out, so a layout is still found after a power cycle numbers the devices differently
+        '''
+        return "\n".join( sorted( port_base(name) for name in input_names if self.is_pad_port(name) or self.seqregex.search(name) ) )
 
-                        break # everything's set, break out of for loop.
 
-                    elif ( msg.control in ( 110,111 )):
-                        # AUTODETECT BLM PORT AND SEQ DEVICE ID NUMBER
-                        self.find_BLM_port()
-                        for pad in self.pad :
-                            pad.all_leds_off()
-                            pad.outport.send( mido.Message("sysex", data=[ 0, 32, 41, 9, Pad.GREEN, 7, 48+self.seq_BLM_portnum ] ) )
+    def load_layout_cache(self):
+        if not self.layout_cache or not os.path.exists(self.layout_cache):
+            return {}
+        try:
+            with open(self.layout_cache) as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            log.error("Couldn't read layout cache %s: %s" % (self.layout_cache, e))
+            return {}
 
-                        break
 
-        for x, pad in temppad.items() :
+    def save_layout(self):
+        '''
+        Saves the layout chosen in the interactive setup - pad order (which also gives each pad's rotation), BLM port and SEQ device ID -
+        keyed by the MIDI input port names currently present.
+        '''
+        if not self.layout_cache or self.seq_BLM_portnum not in (1,2,3,4):
+            return
+
+        cache = self.load_layout_cache()
+        cache[ self.layout_key( mido.get_input_names() ) ] = {
+            "pads": [ pad.name for pad in self.pad ],
+            "seq_BLM_portnum": self.seq_BLM_portnum,
+            "seq_device_id": self.seq.syx_dev_id,
+        }
+        self.write_layout_cache(cache)
+
+
+    def forget_layout(self):
+        '''removes the cached layout for the MIDI ports currently present, so the next start runs the interactive setup'''
+        cache = self.load_layout_cache()
+        if cache.pop( self.layout_key( mido.get_input_names() ), None ):
+            self.write_layout_cache(cache)
+
+
+    def write_layout_cache(self, cache):
+        try:
+            with open(self.layout_cache, "w") as f:
+                json.dump(cache, f, indent=2)
+        except OSError as e:
+            log.error("Couldn't write layout cache %s: %s" % (self.layout_cache, e))
+
+
+    def open_pads(self, padnames, numbered=False):
+        '''
+        open and set up the Launchpads called padnames all at once.  With numbered set, they're numbered in padnames order.
+        If any of them can't be opened, the ones that were are closed again and SetupError is raised.
+        '''
+        import concurrent.futures
+        with concurrent.futures.ThreadPoolExecutor( max(len(padnames), 1) ) as pool:
+            futures = [ pool.submit(Pad, self, name, padnum if numbered else -1) for padnum, name in enumerate(padnames) ]
+
+        pads, errors = [], []
+        for name, future in zip(padnames, futures):
+            try:
+                pads.append( future.result() )
+            except Exception as e:
+                errors.append( "%s (%s)" % (name, e) )
+        if errors:
+            self.close_pads(pads)
+            raise SetupError("Couldn't open Launchpad %s" % ", ".join(errors))
+        return pads
+
+    def close_pads(self, pads):
+        '''close the ports of pads the setup isn't using'''
+        for pad in pads:
             pad.inport.close()
-        del temppad
+            pad.outport.close()
 
 
-    def find_BLM_port(self):
+    def restore_layout(self):
         '''
-        Find BLM port by listening on each of the four seq ports until we hear a response to our ping
+        If the same MIDI ports are present as when a layout was saved, set up the pads and the SEQ from the
+        layout cache, without the interactive setup.  Returns True if it did.
         '''
-        tempseqports = {}
-        tempseqports[1] = mido.open_ioport(self.seq_portnames[1], callback = lambda msg: self.check_seq(1, msg) )
-        tempseqports[2] = mido.open_ioport(self.seq_portnames[2], callback = lambda msg: self.check_seq(2, msg) )
-        tempseqports[3] = mido.open_ioport(self.seq_portnames[3], callback = lambda msg: self.check_seq(3, msg) )
-        tempseqports[4] = mido.open_ioport(self.seq_portnames[4], callback = lambda msg: self.check_seq(4, msg) )
+        input_names = mido.get_input_names()
+        layout = self.load_layout_cache().get( self.layout_key(input_names) )
+        if not layout:
+            return False
+
+        self.find_ports(input_names)
+        if layout["seq_BLM_portnum"] not in self.seq_portnames:
+            return False
 
+        # the pads by the names they have now.  If identical Launchpads have been renumbered, there's no telling
+        # which is which - picking one would silently swap pads round, so run the interactive setup instead
+        for name in layout["pads"]:
+            if is_ambiguous(name, input_names):
+                log.info("Launchpad %s has been renumbered, and there are several like it - running the setup" % name)
+                return False
+
+        padnames = []
+        for name in layout["pads"]:
+            name = find_port(name, set(input_names) - set(padnames))
+            if name is None:
+                return False
+            padnames.append(name)
+
+        self.pad = self.open_pads(padnames, numbered=True)
+
+        self.seq_BLM_portnum = layout["seq_BLM_portnum"]
+        self.seq = Seq( self.seq_portnames[ self.seq_BLM_portnum ], self.seq_BLM_portnum, self, layout["seq_device_id"] )
+        log.info("Restored cached layout - %i Launchpads, SEQ BLM port %i" % ( len(self.pad), self.seq_BLM_portnum ))
+        return True
+
+
+    def find_BLM_port(self, burst=True, timeout=0.3):
+        '''
+        Find BLM port and SEQ device ID by pinging on each of the four seq ports until we hear a response.
+
+        burst mode sends pings for all 128 device IDs to all four ports at once, then waits up to timeout seconds
+        for the reply.  If nothing answers, or burst is False, fall back to pinging one device ID at a time.
+        '''
         self.seq_BLM_portnum = 0
-        for dev_id_test in range(128):
-            if (dev_id_test < 64):
-                color = Pad.GREEN
-                pos = dev_id_test
-            else:
-                color = Pad.DIM_ORANGE
-                pos = dev_id_test - 64
+        self.seq_found = threading.Event()
+        self.seq_reply = None # (portnum, device_id) of the first ping response
+
+        tempseqports = {}
+        for num in (1, 2, 3, 4):
+            tempseqports[num] = mido.open_ioport(self.seq_portnames[num], callback = lambda msg, num=num: self.check_seq(num, msg) )
 
+        if burst:
             for pad in self.pad:
-                pad.set_ledxy(pos//8, pos%8, color)
+                for i in range(8):
+                    pad.set_ledxy(0, i, Pad.GREEN)
 
             for num, port in tempseqports.items():
-                ping=[ 0x00, 0x00, 0x7E, 0x4E, dev_id_test, 0x0F ]
-                pingmsg=mido.Message("sysex", data=ping )
-                port.send(pingmsg)
+                for dev_id_test in range(128):
+                    port.send( mido.Message("sysex", data=[ 0x00, 0x00, 0x7E, 0x4E, dev_id_test, 0x0F ]) )
 
-            if self.seq_BLM_portnum not in (1,2,3,4):
-                time.sleep(.1)
-            else:
-                break
+            if not self.seq_found.wait(timeout):
+                log.info("No reply to burst ping - pinging one device ID at a time")
+
+        if not self.seq_found.is_set():
+            for dev_id_test in range(128):
+                if (dev_id_test < 64):
+                    color = Pad.GREEN
+                    pos = dev_id_test
+                else:
+                    color = Pad.DIM_ORANGE
+                    pos = dev_id_test - 64
+
+                for pad in self.pad:
+                    pad.set_ledxy(pos//8, pos%8, color)
+
+                for num, port in tempseqports.items():
+                    ping=[ 0x00, 0x00, 0x7E, 0x4E, dev_id_test, 0x0F ]
+                    pingmsg=mido.Message("sysex", data=ping )
+                    port.send(pingmsg)
+
+                if self.seq_found.wait(.1):
+                    break
 
         for i, port in tempseqports.items():
             port.close()
         del tempseqports
 
-
-    def check_seq(self, portnum, msg):
-        '''temporary callback used when searching for the SEQ BLM Port'''
-        if (self.seq_BLM_portnum in (1,2,3,4)) or ( msg.type != "sysex" ):
-            return
-        elif ( msg.data == (0,0,126,78,0,15,0) ): # received a ping response from SEQ
-            device_id = msg.data[4]
+        if self.seq_reply:
+            portnum, device_id = self.seq_reply
             self.seq_BLM_portnum = portnum
             self.seq = Seq( self.seq_portnames[ portnum ], self.seq_BLM_portnum, self, device_id )
             log.debug( "Success - SEQ ping response.  Configured BLM on SEQ port %s, device ID %i" % (portnum, device_id))
 
 
+    def check_seq(self, portnum, msg):
+        '''temporary callback used when searching for the SEQ BLM Port - records the port and device ID of the first ping response'''
+        if self.seq_found.is_set() or ( msg.type != "sysex" ):
+            return
+        elif ( msg.data[:4] == (0,0,126,78) and msg.data[5:] == (15,0) ): # received a ping response from SEQ - device ID is msg.data[4]
+            self.seq_reply = ( portnum, msg.data[4] )
+            self.seq_found.set()
+
+
     def grid_config(self):
         '''
         Determines the full BLM layout, from the number of launchpads connected.
@@ -794,8 +2470,7 @@ class pyBLM:
             self.numxrows = 2
             self.numxcols = 2
         else:
-            print >>sys.stderr, 'ERROR: %s' % "Unacceptable number of connected launchpads - must be 1, 2 or 4"
-            sys.exit(1)
+            raise SetupError("Unacceptable number of connected launchpads - must be 1, 2 or 4")
 
         # build the temp row and column maps - each pad's xrow/colmaps contain tuples (status_byte, ledAddress)
         tempxrowmap = []
@@ -807,24 +2482,30 @@ class pyBLM:
         tempxcolmap.append( list( map(lambda T: list(T)+[1], Pad.xcolmap[1] ) ) + list( map(lambda T: list(T)+[3], Pad.xcolmap[3] ) ) )
 
         # build the extra row and column maps
+        self.xrowmap = LedMap(self, 2, 16, interactive=True)
+        self.xcolmap = LedMap(self, 2, 16, interactive=True)
         for i in range(2):
-            self.xrowmap.append(list())
-            self.xcolmap.append(list())
             for col in range(16):
-                self.xrowmap[i].append( Led( self, 100+i, col, tempxrowmap[i][col][2], tempxrowmap[i][col][1], tempxrowmap[i][col][0] ) )
-                self.xcolmap[i].append( Led( self, col, 100+i, tempxcolmap[i][col][2], tempxcolmap[i][col][1], tempxcolmap[i][col][0] ) )
-
-                if i < self.numxrows and col < self.numcols:
-                    button_ledaddress = tempxrowmap[i][col][1] if tempxrowmap[i][col][0] == 0x90 else tempxrowmap[i][col][1]+200
-                    self.pad[tempxrowmap[i][col][2]].buttonmap[button_ledaddress]=Button(100+i, col)
+                status, address, padnum = tempxrowmap[i][col]
+                if padnum < len(self.pad):
+                    self.xrowmap.set_led(i, col, padnum, address, status)
+
+                status, address, padnum = tempxcolmap[i][col]
+                if padnum < len(self.pad):
+                    self.xcolmap.set_led(i, col, padnum, address, status)
+
+                # extra row buttons - only the first extra row is sent to the SEQ, the second could be used for special functions later
+                if i == 0 and col < self.numcols:
+                    status, address, padnum = tempxrowmap[i][col]
+                    self.pad[padnum].map_button(status, address, 100, col, 0x90, 0x60+col)
+                # extra column buttons - col is the row here
                 if i < self.numxcols and col < self.numrows :
-                    button_ledaddress = tempxcolmap[i][col][1] if tempxcolmap[i][col][0] == 0x90 else tempxcolmap[i][col][1]+200
-                    self.pad[tempxcolmap[i][col][2]].buttonmap[button_ledaddress]=Button(col, 100+i)
+                    status, address, padnum = tempxcolmap[i][col]
+                    self.pad[padnum].map_button(status, address, col, 100+i, 0x90+col, ( 0x40, 0x51 )[i])
 
-        self.ledmap=[] # zero based 2d matrix - map[row][col]=Led object
-        # create master led address grid
+        # create master led address grid.  Always 16x16 so the SEQ can address any LED - positions without a pad stay unmapped
+        self.ledmap = LedMap(self, 16, 16)
         for row in range(self.numrows):
-            col_list=[]
             for col in range(self.numcols):
                 if (row<8 and col<8):
                     padnum=0
@@ -844,56 +2525,65 @@ class pyBLM:
                     offsetcol=8
 
                 ledaddress=self.pad[padnum].map[row-offsetrow][col-offsetcol]
-                col_list.append(Led(self, row, col, padnum, ledaddress, 0x90))
+                self.ledmap.set_led(row, col, padnum, ledaddress, 0x90)
 
+                self.pad[padnum].map_button(0x90, ledaddress, row, col, 0x90+row, col)
 
-                self.pad[padnum].buttonmap[ledaddress]=Button(row, col)
-            self.ledmap.append(col_list)
+        self.cctable = self.build_cctable()
+
+        for pad in self.pad:
+            pad.compile_output()
+            pad.start_writer(self.writer_queue_size, self.writer_overflow)
+        self.seq.start_writer(self.writer_queue_size, self.seq_overflow)
 
         #self.print_ledmap()
 
+    def build_cctable(self):
+        '''
+        Precompiles the decoder for the SEQ's optimized row/column pattern transfer protocol.
+
+        Returns a 128 entry list indexed by CC number.  Entries are None for CCs we don't handle, or a tuple of
+        (LedMap update function, fixed row/col index - None to take it from the MIDI channel, half, colour plane, MSB)
+        Each pattern base CC covers four numbers: +0/+1 first half of the row/col, +2/+3 second half.
+        The odd numbers carry the 8th LED of the pattern, which doesn't fit in the 7 bit CC value.
+        '''
+        targets = [
+            # green base CC, red base CC, update function, fixed index
+            ( 0x10, 0x20, self.ledmap.update_row, None ), # BLM16x16 rows
+            ( 0x18, 0x28, self.ledmap.update_col, None ), # BLM16x16 columns - 90 degree rotated view, LSB at the top
+            ( 0x40, 0x48, self.xcolmap.update_row, 0 ), # extra column #1 - always sent over the same channel
+            ( 0x50, 0x58, self.xcolmap.update_row, 1 ), # extra column #2
+            ( 0x60, 0x68, self.xrowmap.update_row, 0 ), # extra row
+        ]
+
+        cctable = [None] * 128
+        for greenbase, redbase, update, index in targets:
+            for offset in range(4):
+                half = offset >> 1
+                msb = 0b10000000 if offset & 1 else 0b0
+                cctable[greenbase+offset] = ( update, index, half, LedMap.GREEN_PLANE, msb )
+                cctable[redbase+offset] = ( update, index, half, LedMap.RED_PLANE, msb )
+
+        return cctable
+
     def print_ledmap(self):
         '''test function - used to check that ledmap is being constructed properly'''
         outstr = "LEDMAP\n"
-        for row in self.ledmap:
-            for col in row:
-                addr='{0:03d}'.format(col.ledaddress)
-                outstr += addr+"   "
+        for row in range(self.numrows):
+            for addr in self.ledmap.address[row*16:row*16+self.numcols]:
+                outstr += '{0:03d}'.format(addr)+"   "
             outstr += "\n"
         print(outstr)
         print()
 
-        outstr = "XCOLMAP[0]\n"
-        for col in self.xcolmap[0]:
-            addr='{0:03d}'.format(col.ledaddress)
-            outstr += addr+"   "
-        outstr += "\n"
-        print(outstr)
-        print()
-
-        outstr = "XCOLMAP[1]\n"
-        for col in self.xcolmap[1]:
-            addr='{0:03d}'.format(col.ledaddress)
-            outstr += addr+"   "
-        outstr += "\n"
-        print(outstr)
-        print()
-
-        outstr = "XROWMAP[0]\n"
-        for col in self.xrowmap[0]:
-            addr='{0:03d}'.format(col.ledaddress)
-            outstr += addr+"   "
-        outstr += "\n"
-        print(outstr)
-        print()
-
-        outstr = "XROWMAP[1]\n"
-        for col in self.xrowmap[1]:
-            addr='{0:03d}'.format(col.ledaddress)
-            outstr += addr+"   "
-        outstr += "\n"
-        print(outstr)
-        print()
+        for name, ledmap in ( ("XCOLMAP", self.xcolmap), ("XROWMAP", self.xrowmap) ):
+            for i in range(2):
+                outstr = "%s[%i]\n" % (name, i)
+                for addr in ledmap.address[i*16:i*16+16]:
+                    outstr += '{0:03d}'.format(addr)+"   "
+                outstr += "\n"
+                print(outstr)
+                print()
 
 
 
@@ -908,12 +2598,29 @@ class pyBLM:
 
         '''
 
-        self.seq.inport.callback = self.seq.callback
-        self.seq.send_layout()
+        self.scheduler.start()
+
+        self.seq.listen(self.seq.callback)
+        self.seq.send_layout() # the SEQ answers with its LEDs whenever it gets to it - nothing to wait for here
 
-        time.sleep(1)
         for pad in self.pad:
-            pad.inport.callback = pad.callback
+            pad.listen(pad.rtmidi_callback, pad.callback)
+            pad.resync() # the setup screens have left the pads out of step with the frame
+
+
+    def flush(self):
+        '''send the LEDs changed since the last flush to every pad, as far as their output budgets allow'''
+        since = self.pending_since
+        self.pending_since = None
+        if since is not None:
+            stats.record("seq flush", since)
+
+        held = False
+        for pad in self.pad:
+            if pad.flush(since):
+                held = True
+        if held:
+            self.scheduler.request() # come back for what the output budgets held back
 
 
     def print_connections(self):
@@ -926,7 +2633,249 @@ class pyBLM:
         print("message: %s" % msg)
 
 
+ButtonEvent = collections.namedtuple("ButtonEvent", "row col pressed") # BLM coordinates - row 100 is the extra row, col 100/101 the extra columns
+
+
+class AsyncFlushScheduler(dict):
+    '''
+    asyncio version of FlushScheduler - flushes LED output from a task on the event loop, at most max_rate times per second.
+    request() may be called from any thread - a pad reopened off the loop resyncs itself if its port writer drops messages.
+    '''
+
+    def __init__(self, parent_blm, max_rate=100):
+        dict.__init__(self)
+        self.__dict__ = self
+        self.parent = parent_blm
+        self.asyncio = parent_blm.asyncio
+        self.loop = parent_blm.loop
+        self.interval = 1.0 / max_rate
+        self.pending = self.asyncio.Event()
+
+    def request(self):
+        try:
+            on_loop = self.asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            on_loop = False
+        if on_loop:
+            self.pending.set()
+        else:
+            self.loop.call_soon_threadsafe(self.pending.set)
+
+    async def run(self):
+        loop = self.asyncio.get_running_loop()
+        next_flush = loop.time()
+        while True:
+            await self.pending.wait()
+
+            delay = next_flush - loop.time()
+            if delay > 0:
+                await self.asyncio.sleep(delay)
+
+            self.pending.clear()
+            try:
+                self.parent.flush()
+            except Exception:
+                log.exception("LED flush failed")
+                trace.dump()
+            next_flush = loop.time() + self.interval
+
+
+class AsyncBLM(pyBLM):
+    '''
+    asyncio BLM engine, for embedding pyBLM in other asyncio software.
+
+    The rtmidi callback threads only hand their messages to the event loop with call_soon_threadsafe.  Decoding,
+    button translation, LED flushing and the link monitor all run on the loop, so the BLM state is only touched from one thread.
+    Nothing on the loop waits for a port: the SEQ's writer queues past its limit rather than block while the SEQ is stalled.
+
+        blm = AsyncBLM()
+        await blm.start()
+        async for event in blm.button_events():
+            ...
+        await blm.stop()
+    '''
+
+    seq_overflow = "spill"
+
+    def __init__(self, max_flush_rate=100, max_events=256, writer_queue_size=1024, writer_overflow="drop_oldest", layout_cache="~/.pyBLM_layout.json",
+                 seq_regex=None, pad_regex=None, pad_rate=None, publish=None, publish_rate=30):
+        import asyncio
+        self.asyncio = asyncio # only imported by this engine, so the threaded one starts faster
+        pyBLM.__init__(self, max_flush_rate, False, writer_queue_size, writer_overflow, layout_cache, seq_regex, pad_regex, pad_rate, publish, publish_rate)
+        self.max_flush_rate = max_flush_rate
+        self.max_events = max_events
+        self.loop = None
+        self.tasks = []
+        self.polling = None # the link monitor's port poll running in the executor
+        self.seq_queue = None
+        self.events = None
+
+    async def start(self):
+        '''
+        Runs the interactive setup, then starts the BLM tasks.  Returns once the BLM is running.
+        '''
+        self.loop = self.asyncio.get_running_loop()
+        self.seq_queue = self.asyncio.Queue()
+        self.events = self.asyncio.Queue(self.max_events)
+        self.scheduler = AsyncFlushScheduler(self, self.max_flush_rate)
+
+        # opening the ports and setting up the pads blocks, and setup waits for button presses - keep them off the loop
+        if not await self.loop.run_in_executor(None, self.restore_layout):
+            await self.loop.run_in_executor(None, self.connect)
+            await self.loop.run_in_executor(None, self.save_layout)
+        self.grid_config()
+
+        self.tasks = [ self.loop.create_task(coro) for coro in ( self.scheduler.run(), self.decode_task(), self.monitor_task() ) ]
+
+        self.seq.listen(self.seq_input)
+        self.seq.send_layout()
+
+        for pad in self.pad:
+            pad.listen( lambda event, data=None, pad=pad: self.loop.call_soon_threadsafe(self.pad_input, pad, event[0]), lambda msg, pad=pad: self.loop.call_soon_threadsafe(self.pad_input, pad, msg.bytes()) )
+            pad.resync()
+
+        if self.publisher:
+            if not self.publisher.running: # stopped with the BLM before - its thread and sockets are gone
+                self.publisher = FramePublisher(self, self.publisher.address, self.publisher.max_rate)
+            self.publisher.start()
+        self.print_connections()
+
+    async def stop(self):
+        '''Stops the BLM tasks, turns off the pads and closes all ports'''
+        for device in [ self.seq ] + self.pad:
+            if device.inport is not None:
+                device.inport.callback = None
+
+        for task in self.tasks:
+            task.cancel()
+        await self.asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        if self.polling is not None:
+            # cancelling the monitor task doesn't stop a poll running in the executor - let it finish
+            await self.asyncio.gather(self.polling, return_exceptions=True)
+            self.polling = None
+        if self.publisher:
+            await self.loop.run_in_executor(None, self.publisher.stop)
+
+        for pad in self.pad:
+            pad.all_leds_off()
+        # the port writers finish sending and their threads are joined - keep that off the loop
+        await self.loop.run_in_executor(None, self.close_devices)
+
+        # end any running button_events iterators
+        while self.events.full():
+            self.events.get_nowait()
+        self.events.put_nowait(None)
+
+    def close_devices(self):
+        '''stop the port writers and close the SEQ's and pads' ports - blocks until everything queued has been sent'''
+        for device in [ self.seq ] + self.pad:
+            device.rawport.stop()
+            if device.inport is not None:
+                device.inport.close()
+                device.outport.close()
+        self.monitor.close()
+
+    async def button_events(self):
+        '''async iterator of ButtonEvents - ends when the BLM is stopped'''
+        while True:
+            event = await self.events.get()
+            if event is None:
+                return
+            yield event
+
+    async def decode_task(self):
+        while True:
+            msg = await self.seq_queue.get()
+            t0 = time.perf_counter() if stats.enabled else None
+            self.seq.decode(msg)
+
+            # decode everything that's already waiting before asking for a flush
+            while not self.seq_queue.empty():
+                self.seq.decode(self.seq_queue.get_nowait())
+            if t0 is not None:
+                self.seq.record_decode(t0)
+            self.scheduler.request()
+
+    async def monitor_task(self):
+        self.monitor.start()
+        while True:
+            # listing, closing and reopening the ports talks to the MIDI driver - do that off the loop, and the rest of the check on it
+            recovered = False
+            if self.monitor.ports_due():
+                self.polling = self.loop.run_in_executor(None, self.monitor.poll_ports)
+                recovered = await self.asyncio.shield(self.polling) # stop waits for it
+            self.monitor.check_link(recovered)
+            await self.asyncio.sleep(self.monitor.interval)
+
+    def seq_input(self, msg):
+        '''SEQ input callback - runs on the MIDI input thread, and hands the message to the event loop'''
+        self.seq.record_input(msg)
+        self.loop.call_soon_threadsafe(self.seq_queue.put_nowait, msg)
+
+    def pad_input(self, pad, data):
+        '''handle a raw message from a pad - runs on the event loop'''
+        pad.press(data)
+
+        if len(data) == 3:
+            button = pad.buttons.get( (data[0] << 8) | data[1] )
+            if button is not None:
+                try:
+                    self.events.put_nowait( ButtonEvent(button[0], button[1], data[2] != 0 and data[0] != 0x80) )
+                except self.asyncio.QueueFull:
+                    pass # nobody is listening - drop it
+
+
 if __name__ == "__main__":
-    # create a new BLM object
+    parser = argparse.ArgumentParser(description="Headless MIDIbox SEQ BLM using Novation Launchpads")
+    parser.add_argument("--setup", action="store_true", help="ignore the layout cache and run the interactive setup")
+    parser.add_argument("--layout-cache", default="~/.pyBLM_layout.json", help="file the pad layout and SEQ port are saved in (default: %(default)s)")
+    parser.add_argument("--seq-regex", help="regular expression matching the SEQ's USB MIDI ports, group 1 the port number (default: %s)" % pyBLM.SEQ_REGEX.replace("%", "%%"))
+    parser.add_argument("--pad-regex", help="only use Launchpads whose MIDI port names match this regular expression")
+    parser.add_argument("--pad-rate", type=int, help="USB MIDI packets per second sent to each Launchpad - LED feedback for button presses goes first, pattern updates get what's left (default: %i, 0 for no limit)" % ClassicDriver.packet_rate)
+    parser.add_argument("--publish", metavar="[HOST:]PORT", help="stream the LED state to remote viewers (viewer.py) on this TCP and UDP port - localhost unless HOST is given, 0.0.0.0 for the LAN")
+    parser.add_argument("--publish-rate", type=float, default=30, help="maximum frames per second sent to each viewer (default: %(default)s)")
+    parser.add_argument("--log-file", help="log to this file instead of pyBLM.log")
+    parser.add_argument("--trace-size", type=int, default=4096, help="number of incoming MIDI messages kept for the trace dumped on SIGQUIT or an error (default: %(default)s)")
+    parser.add_argument("--stats", action="store_true", help="collect latency histograms and message rates - send SIGUSR2 to log them")
+    parser.add_argument("--startup-profile", action="store_true", help="log how long each startup phase took")
+    parser.add_argument("--capture", metavar="FILE", help="record all SEQ and pad input to FILE, for replay with bench.py --replay")
+    args = parser.parse_args()
+
+    if args.log_file:
+        set_logfile(args.log_file)
+    log.error('pyBLM launched.')
+
+    if args.startup_profile:
+        startup.enabled = True
+        startup.mark("imports and module setup")
+
+    if args.capture:
+        capture.start(args.capture)
+
+    trace.size = args.trace_size
+    trace.clear()
+    signal.signal(signal.SIGQUIT, trace.dump)
+    trace_exceptions()
+    signal.signal(signal.SIGUSR1, profiler.toggle)
+
+    if args.stats:
+        stats.enabled = True
+        signal.signal(signal.SIGUSR2, stats.dump)
+
+    publish = None
+    if args.publish:
+        host, sep, port = args.publish.rpartition(":")
+        publish = ( host.strip("[]") or "localhost", int(port) )
+
+    if args.setup:
+        pyBLM(run=False, layout_cache=args.layout_cache, seq_regex=args.seq_regex, pad_regex=args.pad_regex).forget_layout()
 
-    BLM = pyBLM()
+    # create a new BLM object
+    try:
+        BLM = pyBLM(layout_cache=args.layout_cache, seq_regex=args.seq_regex, pad_regex=args.pad_regex, pad_rate=args.pad_rate, publish=publish, publish_rate=args.publish_rate)
+    except SetupError as e:
+        log.error('ERROR: %s' % e)
+        sys.exit(1)
+    finally:
+        capture.stop()
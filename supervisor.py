@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+'''
+Runs several BLMs side by side - one worker process per SEQ and its group of Launchpads, each pinned to a CPU core,
+with its own log file, layout cache, stats and MIDI trace.  A worker that dies is restarted without touching the others.
+
+    ./supervisor.py rig.json
+
+rig.json lists the workers.  seq_regex picks the SEQ's four USB ports (group 1 is the port number) and pad_regex
+the Launchpads that belong to it.  Everything else is optional:
+
+    { "workers": [
+        { "name": "left",  "seq_regex": "MIDIbox SEQ V4:MIDIbox SEQ V4 MIDI ([1-4]) 20:", "pad_regex": "Launchpad S [12]:" },
+        { "name": "right", "seq_regex": "MIDIbox SEQ V4 1:MIDIbox SEQ V4 1 MIDI ([1-4])", "pad_regex": "Launchpad S [34]:",
+          "cpu": 3, "log": "right.log", "layout_cache": "~/.pyBLM_right.json", "max_flush_rate": 60, "stats": true }
+    ] }
+
+SIGUSR1, SIGUSR2 and SIGQUIT are passed on to every worker - they toggle the profiler, and log their stats and MIDI traces.
+'''
+
+import argparse, json, logging, multiprocessing, os, signal, sys, time
+
+log = logging.getLogger("supervisor")
+
+
+def run_worker(config):
+    '''worker process - one BLM, never returns unless it fails'''
+    os.environ["PYBLM_LOG"] = config["log"] # before pyBLM is imported, so it never touches pyBLM.log
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # Ctrl+C is the supervisor's to handle
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    # the supervisor forwards these, and by default they kill us - ignore them until pyBLM is imported and handles them
+    for signum in (signal.SIGQUIT, signal.SIGUSR1, signal.SIGUSR2):
+        signal.signal(signum, signal.SIG_IGN)
+    if config.get("cpu") is not None and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, { config["cpu"] })
+
+    import pyBLM
+    pyBLM.trace_exceptions()
+    signal.signal(signal.SIGQUIT, pyBLM.trace.dump)
+    pyBLM.profiler.prefix = "pyBLM-profile-%s" % config["name"]
+    signal.signal(signal.SIGUSR1, pyBLM.profiler.toggle)
+    if config.get("stats"):
+        pyBLM.stats.enabled = True
+        signal.signal(signal.SIGUSR2, pyBLM.stats.dump)
+    else:
+        signal.signal(signal.SIGUSR2, signal.SIG_IGN)
+
+    pyBLM.log.info("Worker %s on CPU %s" % (config["name"], config.get("cpu")))
+    try:
+        pyBLM.pyBLM(max_flush_rate=config.get("max_flush_rate", 100), layout_cache=config["layout_cache"],
+                    seq_regex=config.get("seq_regex"), pad_regex=config.get("pad_regex"))
+    except Exception:
+        # multiprocessing reports the exception on our stderr, not through sys.excepthook - log it and the trace here
+        pyBLM.log.exception("Worker %s failed" % config["name"])
+        pyBLM.trace.dump()
+        raise
+
+
+class Worker(dict):
+    '''one BLM worker process, and its restart bookkeeping'''
+
+    min_backoff = 1.0 # seconds before restarting a worker that died
+    max_backoff = 30.0 # ... doubling up to this while it keeps dying within stable_time of starting
+    stable_time = 30.0
+
+    def __init__(self, config, context):
+        dict.__init__(self)
+        self.__dict__ = self
+        self.name = config["name"]
+        self.config = config
+        self.context = context
+        self.process = None
+        self.started = None
+        self.restart_at = None # monotonic time of the next restart, while the worker is down
+        self.backoff = self.min_backoff
+        self.restarts = 0
+
+    def start(self):
+        self.process = self.context.Process(target=run_worker, args=(self.config,), name="pyBLM %s" % self.name)
+        self.process.start()
+        self.started = time.monotonic()
+        self.restart_at = None
+        log.info("Started worker %s - pid %i, CPU %s, log %s" % (self.name, self.process.pid, self.config.get("cpu"), self.config["log"]))
+
+    def check(self):
+        '''notice a dead worker, and restart it once its backoff has passed'''
+        now = time.monotonic()
+        if self.restart_at is None:
+            if self.process.is_alive():
+                return
+            self.process.join()
+            ran = now - self.started
+            if ran >= self.stable_time:
+                self.backoff = self.min_backoff
+            self.restart_at = now + self.backoff
+            log.error("Worker %s exited with code %s after %.1f s - restarting in %.0f s" % (self.name, self.process.exitcode, ran, self.backoff))
+            self.backoff = min(self.backoff * 2, self.max_backoff)
+        elif now >= self.restart_at:
+            self.restarts += 1
+            self.start()
+
+    def signal(self, signum):
+        if self.restart_at is None and self.process.is_alive():
+            os.kill(self.process.pid, signum)
+
+    def stop(self, timeout=5):
+        if self.process is not None and self.process.is_alive():
+            self.process.terminate()
+            self.process.join(timeout)
+            if self.process.is_alive():
+                self.process.kill()
+                self.process.join()
+
+
+class Supervisor(dict):
+
+    def __init__(self, configs):
+        dict.__init__(self)
+        self.__dict__ = self
+        context = multiprocessing.get_context("spawn") # fresh processes - no MIDI ports or threads inherited from us
+        self.workers = [ Worker(config, context) for config in configs ]
+        self.running = False
+
+    def run(self, interval=0.2):
+        self.running = True
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGUSR1, self.forward)
+        signal.signal(signal.SIGUSR2, self.forward)
+        signal.signal(signal.SIGQUIT, self.forward)
+
+        for worker in self.workers:
+            worker.start()
+        try:
+            while self.running:
+                for worker in self.workers:
+                    worker.check()
+                time.sleep(interval)
+        finally:
+            for worker in self.workers:
+                worker.stop()
+            log.info("All workers stopped")
+
+    def stop(self, signum=None, frame=None):
+        self.running = False
+
+    def forward(self, signum, frame=None):
+        for worker in self.workers:
+            worker.signal(signum)
+
+
+def load_config(filename):
+    '''reads the worker list, filling in the defaults - CPUs are handed out in turn from the ones we may run on'''
+    with open(filename) as f:
+        configs = json.load(f)["workers"]
+
+    cpus = sorted( os.sched_getaffinity(0) ) if hasattr(os, "sched_getaffinity") else [ None ]
+    names = set()
+    for i, config in enumerate(configs):
+        config.setdefault("name", str(i + 1))
+        if config["name"] in names:
+            raise ValueError("two workers are called %s" % config["name"])
+        names.add(config["name"])
+        config.setdefault("cpu", cpus[i % len(cpus)])
+        config.setdefault("log", "pyBLM-%s.log" % config["name"])
+        config.setdefault("layout_cache", "~/.pyBLM_layout-%s.json" % config["name"])
+    return configs
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="run one pyBLM worker process per SEQ")
+    parser.add_argument("config", help="JSON file listing the workers")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    Supervisor( load_config(args.config) ).run()
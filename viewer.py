@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+'''
+Remote viewer for the BLM frame streamed by pyBLM.py --publish - draws the LEDs in the terminal, or logs a line
+per frame.  Needs nothing but Python, so it runs on any machine that can reach the BLM.
+
+    ./pyBLM.py --publish 0.0.0.0:7000
+    ./viewer.py blmhost 7000
+    ./viewer.py blmhost 7000 --udp --rate 5 --log
+
+The stream format is described in pyBLM.FramePublisher.
+'''
+
+import argparse, socket, struct, sys, time
+
+MAGIC = b"pBLM"
+VERSION = 1
+KEYFRAME = 0
+DELTA = 1
+header = struct.Struct("<4sBBII")
+length = struct.Struct("<H")
+
+FRAME_SIZE = 80 # packed bytes - red and green bitplanes of the 16x16 grid, the 2x16 extra rows and the 2x16 extra columns
+
+# terminal colour of each LED, indexed by (green << 1) | red
+colors = ( "\x1b[90m.", "\x1b[91mo", "\x1b[92mo", "\x1b[93mo" )
+
+
+class Frame(dict):
+    '''the BLM state as the viewer last received it'''
+
+    def __init__(self):
+        dict.__init__(self)
+        self.__dict__ = self
+        self.packed = None
+        self.seq = None # sequence number of packed
+        self.keyframe = None # the last keyframe, for UDP deltas
+        self.keyframe_seq = None
+        self.layout = (0, 0, 0, 0) # numrows, numcols, numxrows, numxcols
+        self.lost = 0 # deltas we couldn't apply
+
+    def receive(self, msg):
+        '''apply one message.  Returns True if the frame changed'''
+        magic, version, kind, seq, base = header.unpack_from(msg)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("not a pyBLM frame stream")
+        payload = msg[header.size:]
+
+        if kind == KEYFRAME:
+            self.layout = tuple(payload[:4])
+            self.packed = self.keyframe = bytes(payload[4:4+FRAME_SIZE])
+            self.seq = self.keyframe_seq = seq
+            return True
+
+        # a delta applies to the previous message over TCP, to the last keyframe over UDP
+        if base == self.seq:
+            old = self.packed
+        elif base == self.keyframe_seq:
+            old = self.keyframe
+        else:
+            self.lost += 1
+            return False
+        self.packed = apply_delta(old, payload)
+        self.seq = seq
+        return True
+
+    # bit offsets of the red and green planes of the main grid, the extra rows and the extra columns - all 16 wide
+    GRID = (0, 256)
+    XROWS = (512, 544)
+    XCOLS = (576, 608)
+
+    def bit(self, n):
+        return (self.packed[n >> 3] >> (n & 7)) & 1
+
+    def color(self, planes, row, col):
+        i = row * 16 + col
+        return colors[ self.bit(planes[0] + i) | (self.bit(planes[1] + i) << 1) ]
+
+    def draw(self):
+        '''the frame as terminal text - extra rows on top, extra columns on the right'''
+        numrows, numcols, numxrows, numxcols = self.layout
+        lines = []
+        lines.append( " ".join( self.color(self.XROWS, 0, col) for col in range(numcols) ) )
+        lines.append( "" )
+        for row in range(numrows):
+            lines.append( " ".join( self.color(self.GRID, row, col) for col in range(numcols) ) + "   " +
+                          " ".join( self.color(self.XCOLS, xcol, row) for xcol in range(numxcols) ) )
+        return "\n".join(lines) + "\x1b[0m"
+
+    def summary(self):
+        lit = sum( bin(byte).count("1") for byte in self.packed )
+        return "%.3f seq %i %i LED planes lit %s" % ( time.time(), self.seq, lit, self.packed.hex() )
+
+
+def apply_delta(old, payload):
+    '''undo FramePublisher.delta - (zero bytes to skip, count, count XOR bytes) runs'''
+    new = bytearray(old)
+    i = pos = 0
+    while i < len(payload):
+        pos += payload[i]
+        count = payload[i+1]
+        for j in range(count):
+            new[pos + j] ^= payload[i + 2 + j]
+        pos += count
+        i += 2 + count
+    return bytes(new)
+
+
+def tcp_messages(host, port, rate):
+    sock = socket.create_connection( (host, port) )
+    if rate:
+        sock.sendall( b"rate %g\n" % rate )
+    data = b""
+    while True:
+        chunk = sock.recv(4096)
+        if not chunk:
+            return
+        data += chunk
+        while len(data) >= length.size:
+            size, = length.unpack_from(data)
+            if len(data) < length.size + size:
+                break
+            yield data[length.size:length.size+size]
+            data = data[length.size+size:]
+
+
+def udp_messages(host, port, rate, renew=3.0):
+    address = socket.getaddrinfo(host, port, type=socket.SOCK_DGRAM)[0][4]
+    sock = socket.socket(socket.AF_INET6 if len(address) == 4 else socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(renew)
+    request = b"subscribe %g" % rate if rate else b"subscribe"
+    renewed = 0
+    try:
+        while True:
+            if time.monotonic() - renewed >= renew:
+                sock.sendto(request, address)
+                renewed = time.monotonic()
+            try:
+                msg = sock.recv(2048)
+            except socket.timeout:
+                continue
+            yield msg
+    finally:
+        sock.sendto(b"unsubscribe", address)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="view the LED state streamed by pyBLM.py --publish")
+    parser.add_argument("host", help="host pyBLM.py runs on")
+    parser.add_argument("port", type=int, help="its --publish port")
+    parser.add_argument("--udp", action="store_true", help="subscribe over UDP instead of connecting over TCP")
+    parser.add_argument("--rate", type=float, help="frames per second to ask for (default: as many as pyBLM sends)")
+    parser.add_argument("--log", action="store_true", help="print a timestamped line per frame instead of drawing the LEDs")
+    parser.add_argument("--frames", type=int, help="exit after this many frames")
+    args = parser.parse_args()
+
+    frame = Frame()
+    messages = udp_messages if args.udp else tcp_messages
+    received = 0
+    try:
+        for msg in messages(args.host, args.port, args.rate):
+            if not frame.receive(msg) or frame.packed is None:
+                continue
+            received += 1
+            if args.log:
+                print( frame.summary(), flush=True )
+            else:
+                sys.stdout.write( "\x1b[H\x1b[2J" + frame.draw() + "\nframe %i, %i lost\n" % (received, frame.lost) )
+                sys.stdout.flush()
+            if args.frames and received >= args.frames:
+                break
+    except KeyboardInterrupt:
+        pass